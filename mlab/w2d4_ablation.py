@@ -0,0 +1,68 @@
+import torch
+
+from w2d4_losses import per_sequence_losses
+
+
+def estimate_forward_bytes(cfg, batch, seq_len, element_size=4):
+    # Rough peak memory of a no-grad forward pass: the logits and their log
+    # softmax, a few attention pattern sized tensors and a few MLP sized tensors
+    d_hidden = cfg.get("d_mlp", 4 * cfg["d_model"])
+    per_token = 2 * cfg["d_vocab"] + 3 * cfg["n_heads"] * seq_len + 4 * d_hidden
+    return element_size * batch * seq_len * per_token
+
+
+def head_ablation_sweep(model, tokens, hook_name="hook_v", memory_budget=2**30):
+    """
+    Zero ablates each attention head in turn and returns the resulting loss, as
+    a [n_layers, n_heads] tensor - ie the same as looping over ablated_head_run,
+    but with all the ablations done in as few forward passes as possible.
+
+    The batch is repeated once per ablated head, and a single hook on
+    hook_name (hook_v or hook_z) zeroes a different head in each replica. The
+    replicas are split into chunks so that each forward pass fits in roughly
+    memory_budget bytes (see estimate_forward_bytes).
+
+    Ablating a head in layer L doesn't change anything before layer L, so we
+    run the clean model once, and run each layer's ablations starting from the
+    clean residual stream going into that layer.
+
+    tokens: [batch, pos]
+    """
+    n_layers, n_heads = model.cfg["n_layers"], model.cfg["n_heads"]
+    batch, seq_len = tokens.shape
+    bytes_per_replica = estimate_forward_bytes(model.cfg, batch, seq_len)
+    heads_per_chunk = max(1, memory_budget // bytes_per_replica)
+
+    clean_resid_pre = {}
+
+    def save_resid_pre_hook(resid_pre, hook):
+        clean_resid_pre[hook.layer()] = resid_pre
+
+    losses = torch.zeros(n_layers, n_heads)
+    with torch.inference_mode():
+        model.run_with_hooks(
+            tokens,
+            fwd_hooks=[(lambda name: name.endswith("hook_resid_pre"), save_resid_pre_hook)],
+            stop_at_layer=n_layers,
+        )
+        for layer in range(n_layers):
+            for start in range(0, n_heads, heads_per_chunk):
+                heads = range(start, min(n_heads, start + heads_per_chunk))
+                # head_mask[replica, head] is 0 iff that replica ablates that head
+                head_mask = torch.ones(len(heads), n_heads, device=tokens.device)
+                head_mask[range(len(heads)), heads] = 0.0
+                # Replica r covers batch elements r * batch to (r + 1) * batch
+                head_mask = head_mask.repeat_interleave(batch, dim=0)
+
+                def ablate_heads_hook(activation, hook):
+                    # activation has shape [replica * batch, pos, head_index, d_head]
+                    return activation * head_mask[:, None, :, None].to(activation.dtype)
+
+                logits = model.run_with_hooks(
+                    clean_resid_pre[layer].repeat(len(heads), 1, 1),
+                    fwd_hooks=[(f"blocks.{layer}.attn.{hook_name}", ablate_heads_hook)],
+                    start_at_layer=layer,
+                )
+                chunk_losses = per_sequence_losses(logits, tokens.repeat(len(heads), 1))
+                losses[layer, heads] = chunk_losses.view(len(heads), batch).mean(-1).cpu()
+    return losses
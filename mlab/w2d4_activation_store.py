@@ -0,0 +1,237 @@
+import bisect
+import json
+import os
+import queue
+import threading
+import warnings
+
+import numpy as np
+import torch
+
+INDEX_FILE = "index.json"
+
+# numpy has no bfloat16, so activations are stored in one of these
+TORCH_TO_NUMPY_DTYPE = {
+    torch.float16: np.float16,
+    torch.float32: np.float32,
+    torch.float64: np.float64,
+}
+
+
+class ActivationStoreWriter:
+    """
+    Streams hook activations to disk, batch by batch, so we can keep activations
+    for far more sequences than fit in memory.
+
+    Each hook gets a series of shards, .npy files holding rows_per_shard rows
+    (the first axis of the activation, normally the batch), which are filled
+    through np.memmap. index.json maps each (hook name, row range) written to the
+    shard and offset it lives in.
+
+    Writing to disk happens on a background thread. The forward pass only copies
+    the activation to CPU and puts it on a queue holding at most max_pending
+    activations, so it only waits on the disk if the disk can't keep up on average.
+
+    Usage:
+        with ActivationStoreWriter("acts/", dtype=torch.float16) as store:
+            store.attach(model, "blocks.*.hook_resid_post")
+            for tokens in batches:
+                model(tokens)
+        reader = ActivationStoreReader("acts/")
+
+    The store's hooks are ordinary hooks, so anything resetting the model's hooks
+    removes them, including run_with_hooks with its defaults. While attached, add
+    other hooks with model.hooks(...) or run_with_hooks(..., reset_hooks_start=False,
+    reset_hooks_end=False) instead. close() warns if the hooks were removed early.
+    """
+
+    def __init__(self, path, rows_per_shard=4096, dtype=torch.float16, max_pending=16):
+        if dtype not in TORCH_TO_NUMPY_DTYPE:
+            raise ValueError(f"Unsupported dtype {dtype}, use one of {list(TORCH_TO_NUMPY_DTYPE)}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.rows_per_shard = rows_per_shard
+        self.dtype = dtype
+        self.hooks = {}
+        self.attached = []
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.open_shards = {}
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def attach(self, model, names):
+        # Adds hooks writing every hook point of model matching names (see
+        # make_name_filter) to the store. The hooks are removed by close(), and
+        # by anything resetting the model's hooks (see the class docstring)
+        def store_hook(tensor, hook):
+            n_bytes = self.write(hook.name, tensor)
+            if hook.profiler is not None:
+                hook.profiler.record_bytes(hook.name, n_bytes)
+
+        for hp in model.matching_hook_points(names):
+            hp.add_hook(store_hook, "fwd")
+            self.attached.append((hp, store_hook))
+
+    def write(self, name, tensor):
+        # Appends tensor to the activations stored for name, splitting it along
+        # the first axis across shards if needed. Returns the number of bytes queued
+        if self.error is not None:
+            raise RuntimeError("Activation store writer thread failed") from self.error
+        array = tensor.detach().to("cpu", self.dtype, copy=True).numpy()
+        if name not in self.hooks:
+            self.hooks[name] = {
+                "dtype": np.dtype(TORCH_TO_NUMPY_DTYPE[self.dtype]).name,
+                "shape": list(array.shape[1:]),
+                "rows_per_shard": self.rows_per_shard,
+                "num_rows": 0,
+                "shards": [],
+                "entries": [],
+            }
+        info = self.hooks[name]
+        if list(array.shape[1:]) != info["shape"]:
+            raise ValueError(
+                f"Activation for {name} has shape {list(array.shape[1:])} after the first axis, "
+                f"but earlier batches had {info['shape']} - pad to a fixed length first"
+            )
+
+        # The index is updated here, so it's consistent with what has been
+        # queued even before the writer thread catches up
+        row = info["num_rows"]
+        start = 0
+        while start < len(array):
+            shard, offset = divmod(row, self.rows_per_shard)
+            stop = min(len(array), start + self.rows_per_shard - offset)
+            if shard == len(info["shards"]):
+                info["shards"].append(f"{name}.{shard:05d}.npy")
+            info["entries"].append([row, row + stop - start, shard, offset])
+            self.queue.put((name, shard, offset, array[start:stop]))
+            row += stop - start
+            start = stop
+        info["num_rows"] = row
+        return array.nbytes
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    name, shard, offset, array = item
+                    self._shard(name, shard)[offset : offset + len(array)] = array
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _shard(self, name, shard):
+        # Only the latest shard of each hook is kept open, since they're filled in order
+        current = self.open_shards.get(name)
+        if current is not None and current[0] == shard:
+            return current[1]
+        if current is not None:
+            current[1].flush()
+        info = self.hooks[name]
+        memmap = np.lib.format.open_memmap(
+            os.path.join(self.path, info["shards"][shard]),
+            mode="w+",
+            dtype=info["dtype"],
+            shape=(self.rows_per_shard, *info["shape"]),
+        )
+        self.open_shards[name] = (shard, memmap)
+        return memmap
+
+    def flush(self):
+        # Waits for everything queued to be written, and writes the index
+        self.queue.join()
+        if self.error is not None:
+            raise RuntimeError("Activation store writer thread failed") from self.error
+        for _, memmap in self.open_shards.values():
+            memmap.flush()
+        with open(os.path.join(self.path, INDEX_FILE), "w") as f:
+            json.dump({"hooks": self.hooks}, f)
+
+    def close(self):
+        removed = [hp.name for hp, hook in self.attached if hook not in hp.fwd_hooks]
+        for hp, hook in self.attached:
+            if hook in hp.fwd_hooks:
+                hp.remove_hook(hook)
+        self.attached = []
+        if removed:
+            warnings.warn(
+                f"The activation store's hooks on {removed} were removed before close(), so batches "
+                "run after that weren't stored (eg run_with_hooks resets hooks unless "
+                "reset_hooks_start=False and reset_hooks_end=False)"
+            )
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.writer_thread.join()
+            self.open_shards = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ActivationStoreReader:
+    """
+    Reads an activation store written by ActivationStoreWriter. Shards are memory
+    mapped, so reading only touches the rows asked for, and get returns a view of
+    the file (no copy) whenever the rows lie in a single shard.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.hooks = json.load(f)["hooks"]
+        self.entry_starts = {name: [entry[0] for entry in info["entries"]] for name, info in self.hooks.items()}
+        self.shards = {}
+
+    def names(self):
+        return list(self.hooks)
+
+    def num_rows(self, name):
+        return self.hooks[name]["num_rows"]
+
+    def shape(self, name):
+        return (self.num_rows(name), *self.hooks[name]["shape"])
+
+    def _shard(self, name, shard):
+        key = (name, shard)
+        if key not in self.shards:
+            # Copy-on-write mode, so torch gets a writeable array without copying the file
+            file = os.path.join(self.path, self.hooks[name]["shards"][shard])
+            self.shards[key] = np.load(file, mmap_mode="c")
+        return self.shards[key]
+
+    def slices(self, name, start=0, stop=None):
+        # Yields zero-copy tensors covering rows start:stop of name, one per shard touched
+        info = self.hooks[name]
+        stop = info["num_rows"] if stop is None else min(stop, info["num_rows"])
+        entries = info["entries"]
+        i = bisect.bisect_right(self.entry_starts[name], start) - 1
+        while start < stop:
+            entry_start, entry_stop, shard, offset = entries[i]
+            piece_stop = min(stop, entry_stop)
+            first = offset + start - entry_start
+            array = self._shard(name, shard)[first : first + piece_stop - start]
+            yield torch.from_numpy(array)
+            start = piece_stop
+            i += 1
+
+    def get(self, name, start=0, stop=None):
+        # Returns rows start:stop of name as a tensor, a view of the file if they
+        # come from a single shard, otherwise a copy
+        pieces = list(self.slices(name, start, stop))
+        if len(pieces) == 0:
+            info = self.hooks[name]
+            return torch.from_numpy(np.empty((0, *info["shape"]), dtype=info["dtype"]))
+        if len(pieces) == 1:
+            return pieces[0]
+        return torch.cat(pieces)
@@ -0,0 +1,162 @@
+import torch
+import torch.nn.functional as F
+
+# F.scaled_dot_product_attention was added in PyTorch 2.0
+HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
+
+def efficient_attention(q, k, v, mask, attn_scale, ignore, is_causal=False, query_chunk_size=128):
+    """
+    Computes z (the attention-weighted values) without materializing the full
+    [batch, head_index, query_pos, key_pos] attention pattern, so memory is linear
+    rather than quadratic in the sequence length. Used by the Attention modules
+    when nothing is hooked on hook_attn_scores or hook_attn.
+
+    Gives the same result as the explicit path: scores are divided by
+    attn_scale, scores where mask is False are set to ignore, then softmaxed.
+    With scaled_dot_product_attention masked scores are instead shifted by
+    ignore, which only differs for queries that can't attend to anything (eg
+    left padding), where the output is meaningless anyway.
+
+    q: [batch, query_pos, head_index, d_head]
+    k, v: [batch, key_pos, head_index, d_head]
+    mask: Boolean, broadcastable to [batch, head_index, query_pos, key_pos], True
+        iff that query position can attend to that key position
+    attn_scale (float): What the scores are divided by
+    ignore: Tensor holding the score used for masked positions
+    is_causal (bool): If True, mask is the plain lower triangular mask with
+        query_pos == key_pos, which allows a faster kernel
+    query_chunk_size (int): Without scaled_dot_product_attention, queries are
+        processed this many at a time
+
+    Returns z: [batch, query_pos, head_index, d_head]
+    """
+    if HAS_SDPA:
+        d_head = q.size(-1)
+        if attn_scale != d_head**0.5:
+            # scaled_dot_product_attention always divides by sqrt(d_head)
+            q = q * (d_head**0.5 / attn_scale)
+        q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)  # [batch, head_index, pos, d_head]
+        if is_causal:
+            z = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        else:
+            attn_bias = torch.where(mask, torch.zeros((), dtype=q.dtype, device=q.device), ignore.to(q.dtype))
+            z = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+        return z.transpose(1, 2)  # [batch, query_pos, head_index, d_head]
+
+    # Otherwise only materialize the pattern for query_chunk_size queries at a time
+    query_pos = q.size(1)
+    z = q.new_empty(q.shape[:-1] + (v.size(-1),))  # [batch, query_pos, head_index, d_head]
+    for start in range(0, query_pos, query_chunk_size):
+        stop = min(query_pos, start + query_chunk_size)
+        attn_scores = torch.einsum("bpih,bqih->bipq", q[:, start:stop], k) / attn_scale
+        attn_scores = torch.where(mask[..., start:stop, :], attn_scores, ignore)
+        attn_matrix = F.softmax(attn_scores, dim=-1)  # [batch, head_index, chunk, key_pos]
+        z[:, start:stop] = torch.einsum("bpih,biqp->bqih", v, attn_matrix)
+    return z
+
+
+def sliding_window_attention(
+    q, k, v, window_size, attn_scale, ignore, attention_mask=None, block_size=128, return_pattern=False
+):
+    """
+    Local attention (each query attends to itself and the window_size - 1
+    positions before it) which only computes scores for query/key pairs that
+    can be inside the window, so time and memory are O(pos * window_size)
+    rather than O(pos^2).
+
+    Queries are split into blocks of block_size. A block
+    of queries starting at position s only needs the keys from
+    s - window_size + 1 to s + block_size, so each block gets a
+    [block_size, block_size + window_size - 1] tile of scores. Masked scores
+    are set to ignore, as in the dense path.
+
+    q: [batch, query_pos, head_index, d_head]
+    k, v: [batch, key_pos, head_index, d_head], where the queries are the last
+        query_pos of the key_pos positions (eg with a key value cache)
+    attention_mask: [batch, key_pos], 0 for padding tokens
+    block_size (int): Smaller blocks waste less work on pairs outside the window,
+        larger ones make for more efficient matrix multiplies. 128 was fastest
+        on CPU for GPT-Neo's window of 256
+    return_pattern (bool): If True, also returns the attention pattern in
+        banded form, [batch, n_blocks, head_index, block_size, block_size + window_size - 1],
+        which banded_to_dense turns into the usual dense pattern
+
+    Returns z: [batch, query_pos, head_index, d_head]
+    """
+    batch, query_pos, n_heads, d_head = q.shape
+    key_pos = k.size(1)
+    block_size = min(block_size, query_pos)
+    n_blocks = -(-query_pos // block_size)
+    span = block_size + window_size - 1
+    offset = key_pos - query_pos  # Position of the first query
+
+    # Pad the keys so key block j is keys[offset + j * block_size : ... + span] of
+    # the padded keys, ie starts window_size - 1 before query block j
+    pad_front = window_size - 1
+    pad_back = n_blocks * block_size - query_pos
+    k = F.pad(k, (0, 0, 0, 0, pad_front, pad_back))[:, offset:]
+    v = F.pad(v, (0, 0, 0, 0, pad_front, pad_back))[:, offset:]
+    # unfold gives views, [batch, n_blocks, head_index, d_head, span]
+    k_blocks = k.unfold(1, span, block_size)
+    v_blocks = v.unfold(1, span, block_size)
+    q_blocks = F.pad(q, (0, 0, 0, 0, 0, pad_back)).view(batch, n_blocks, block_size, n_heads, d_head)
+
+    # Which keys are real (not padding added here or padding tokens), [batch or 1, n_blocks, span]
+    if attention_mask is None:
+        valid = torch.ones((1, key_pos), dtype=torch.bool, device=q.device)
+    else:
+        valid = attention_mask.bool()
+    valid = F.pad(valid, (pad_front, pad_back), value=False)[:, offset:].unfold(1, span, block_size)
+    # Query i of a block can see key j of its tile iff i <= j < i + window_size
+    i = torch.arange(block_size, device=q.device)[:, None]
+    j = torch.arange(span, device=q.device)[None, :]
+    band = (j >= i) & (j < i + window_size)  # [block_size, span]
+    mask = band & valid[:, :, None, None, :]  # [batch or 1, n_blocks, 1, block_size, span]
+
+    attn_scores = torch.einsum("bnqih,bnihk->bniqk", q_blocks, k_blocks) / attn_scale
+    attn_scores = torch.where(mask, attn_scores, ignore)
+    attn_matrix = F.softmax(attn_scores, dim=-1)  # [batch, n_blocks, head_index, block_size, span]
+    z = torch.einsum("bniqk,bnihk->bnqih", attn_matrix, v_blocks)
+    z = z.reshape(batch, n_blocks * block_size, n_heads, d_head)[:, :query_pos]
+    if return_pattern:
+        return z, attn_matrix
+    return z
+
+
+def banded_to_dense(attn_matrix, query_pos, key_pos, window_size):
+    """
+    Turns the banded attention pattern from sliding_window_attention into the
+    dense [batch, head_index, query_pos, key_pos] pattern the explicit path
+    computes (zero outside the window), eg to compare the two
+    """
+    batch, n_blocks, n_heads, block_size, span = attn_matrix.shape
+    offset = key_pos - query_pos
+    dense = attn_matrix.new_zeros(batch, n_heads, n_blocks * block_size, key_pos + window_size - 1 + block_size)
+    for n in range(n_blocks):
+        # Tile n covers padded keys from n * block_size (padded by window_size - 1 at the front)
+        start = n * block_size
+        dense[:, :, start : start + block_size, offset + start : offset + start + span] = attn_matrix[:, n]
+    return dense[:, :, :query_pos, window_size - 1 : window_size - 1 + key_pos]
+
+
+def left_pad(sequences, pad_token_id):
+    """
+    Stacks token sequences of different lengths into a batch, padding on the
+    left so the last position holds the last token of every sequence (which is
+    what generation needs). Use the returned attention_mask so the model ignores
+    the padding.
+
+    sequences: A list of lists or 1D tensors of token ids
+
+    Returns tokens, attention_mask: both [batch, max_length], attention_mask is
+    1 for real tokens and 0 for padding
+    """
+    max_length = max(len(seq) for seq in sequences)
+    tokens = torch.full((len(sequences), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_length), dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        if len(seq) > 0:
+            tokens[i, max_length - len(seq) :] = torch.as_tensor(seq)
+            attention_mask[i, max_length - len(seq) :] = 1
+    return tokens, attention_mask
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import numpy as np
 import einops
 from w2d4_hook_points import HookPoint, HookedRootModule
+from w2d4_attention import efficient_attention, left_pad
 from utils import StaticModuleList
 
 # Define network architecture
@@ -15,12 +16,25 @@ class Embed(nn.Module):
         self.cfg = cfg
         self.W_E = nn.Parameter(torch.empty(self.cfg["d_model"], self.cfg["d_vocab"]))
         nn.init.kaiming_uniform_(self.W_E, a=np.sqrt(5))
+        # If True, W_E is laid out row-major and looked up with F.embedding, see set_row_major
+        self.row_major = False
 
     def forward(self, tokens):
+        if self.row_major:
+            # Gathers a contiguous row per token, already in [batch, pos, d_model] order
+            return F.embedding(tokens, self.W_E.T)
         # If A has shape [a, b] and B has shape [c, d], then A[:, B] has shape [a, c, d]
         # B acts as a tensor of indices into the second dimension (so >=0 and <b)
         return einops.rearrange(self.W_E[:, tokens], "d_model batch pos -> batch pos d_model")
 
+    def set_row_major(self, row_major=True):
+        # Changes how W_E is laid out in memory, not its shape. If row_major, it's
+        # a [d_model, d_vocab] view of a contiguous [d_vocab, d_model] tensor, so
+        # each token's embedding is a contiguous row, otherwise it's contiguous
+        with torch.no_grad():
+            self.W_E.data = self.W_E.T.contiguous().T if row_major else self.W_E.contiguous()
+        self.row_major = row_major
+
 
 class Unembed(nn.Module):
     def __init__(self, cfg):
@@ -28,8 +42,14 @@ class Unembed(nn.Module):
         self.cfg = cfg
         self.W_U = nn.Parameter(torch.empty(self.cfg["d_vocab"], self.cfg["d_model"]))
         nn.init.kaiming_uniform_(self.W_U, a=np.sqrt(5))
+        # If True, the logits are computed with a single matrix multiply
+        self.row_major = False
 
     def forward(self, tokens):
+        if self.row_major:
+            # [batch * pos, d_model] @ [d_model, d_vocab], W_U.T is a view
+            logits = torch.mm(tokens.reshape(-1, tokens.size(-1)), self.W_U.T)
+            return logits.view(tokens.shape[:-1] + (-1,))  # [batch, pos, d_vocab]
         return torch.einsum("vm,bpm->bpv", self.W_U, tokens)  # [batch, pos, d_vocab]
 
 
@@ -41,13 +61,21 @@ class PosEmbed(nn.Module):
         self.W_pos = nn.Parameter(torch.empty(self.cfg["d_model"], self.cfg["n_ctx"]))
         nn.init.kaiming_uniform_(self.W_pos, a=np.sqrt(5))
 
-    def forward(self, x):
-        # Output shape [pos, d_model] - will be broadcast along batch dim
-        return self.W_pos[:, : x.size(-1)].T  # [pos, d_model]
+    def forward(self, x, attention_mask=None):
+        if attention_mask is None:
+            # Output shape [pos, d_model] - will be broadcast along batch dim
+            return self.W_pos[:, : x.size(-1)].T  # [pos, d_model]
+        # attention_mask is [batch, pos], with 0 for padding tokens. With left
+        # padding, the first real token of each sequence is position 0
+        positions = (attention_mask.cumsum(-1) - 1).clamp(min=0)  # [batch, pos]
+        return einops.rearrange(self.W_pos[:, positions], "d_model batch pos -> batch pos d_model")
 
 
 # Attention
 class Attention(nn.Module):
+    # How many heads' results hook_result_chunk gets at a time
+    result_chunk_heads = 1
+
     def __init__(self, cfg, attn_type="global"):
         super().__init__()
         self.cfg = cfg
@@ -76,33 +104,70 @@ class Attention(nn.Module):
         self.hook_qk_input = HookPoint()  # [batch, pos, d_model] - The residual stream + positional embeddings
         self.hook_attn_scores = HookPoint()  # [batch, head_index, query_pos, key_pos]
         self.hook_attn = HookPoint()  # [batch, head_index, query_pos, key_pos]
-        self.hook_result = HookPoint()  # [batch, head_index, head_index, d_model]
+        self.hook_result = HookPoint()  # [batch, pos, head_index, d_model]
+        # The same, streamed a few heads at a time (hook.head_slice says which),
+        # so hooks only needing eg norms or sums never see the full tensor.
+        # cache_all skips it
+        self.hook_result_chunk = HookPoint(cache_by_default=False)  # [batch, pos, head_chunk, d_model]
 
-    def forward(self, x, pos_embed):
+    def forward(self, x, pos_embed, attention_mask=None):
+        # attention_mask: [batch, pos], 0 for padding tokens, which are never attended to
         # We add in the positional embeddings to the residual stream to create qk_input
         # This is the input to JUST the keys and querys, not the values
         qk_input = self.hook_qk_input(x + pos_embed)  # [batch, pos, d_model]
         q = self.hook_q(torch.einsum("ihm,bpm->bpih", self.W_Q, qk_input))  # [batch, pos, head_index, d_head]
         k = self.hook_k(torch.einsum("ihm,bpm->bpih", self.W_K, qk_input))  # [batch, pos, head_index, d_head]
         v = self.hook_v(torch.einsum("ihm,bpm->bpih", self.W_V, x))  # [batch, pos, head_index, d_head]
-        attn_scores = torch.einsum("bpih,bqih->bipq", q, k) / self.attn_scale  # [batch, head_index, query_pos, key_pos]
-        attn_scores = self.hook_attn_scores(
-            self.apply_causal_mask(attn_scores)
-        )  # [batch, head_index, query_pos, key_pos]
-        attn_matrix = self.hook_attn(F.softmax(attn_scores, dim=-1))  # [batch, head_index, query_pos, key_pos]
-        z = self.hook_z(torch.einsum("bpih,biqp->bqih", v, attn_matrix))  # [batch, pos, head_index, d_head]
-
-        if self.cfg["use_attn_result"]:
-            result = self.hook_result(torch.einsum("imh,bqih->bqim", self.W_O, z))  # [batch, pos, head_index, d_model]
-            out = einops.reduce(
-                result, "batch position index model->batch position model", "sum"
-            )  # [batch, pos, d_model]
+        if self.hook_attn_scores.has_hooks() or self.hook_attn.has_hooks():
+            attn_scores = torch.einsum("bpih,bqih->bipq", q, k) / self.attn_scale  # [batch, head_index, query_pos, key_pos]
+            attn_scores = self.hook_attn_scores(
+                self.apply_causal_mask(attn_scores, attention_mask)
+            )  # [batch, head_index, query_pos, key_pos]
+            attn_matrix = self.hook_attn(F.softmax(attn_scores, dim=-1))  # [batch, head_index, query_pos, key_pos]
+            z = torch.einsum("bpih,biqp->bqih", v, attn_matrix)  # [batch, pos, head_index, d_head]
+        else:
+            # Nothing needs the attention pattern, so don't materialize it
+            mask = self.get_mask(q.size(1), k.size(1), attention_mask)
+            z = efficient_attention(q, k, v, mask, self.attn_scale, self.IGNORE, is_causal=attention_mask is None)
+        z = self.hook_z(z)  # [batch, pos, head_index, d_head]
+
+        if self.cfg["use_attn_result"] and (self.hook_result.has_hooks() or self.hook_result_chunk.has_hooks()):
+            out = self.add_head_results(0.0, z)  # [batch, pos, d_model]
         else:
             out = torch.einsum("imh,bqih->bqm", self.W_O, z)  # [batch, pos, head_index, d_model]
         return out
 
-    def apply_causal_mask(self, attn_scores):
-        return torch.where(self.mask[: attn_scores.size(-2), : attn_scores.size(-1)], attn_scores, self.IGNORE)  # type: ignore
+    def add_head_results(self, out, z):
+        # Adds the result of each head to out ([batch, pos, d_model]), running the
+        # use_attn_result hook points. The full [batch, pos, head_index, d_model]
+        # result is only computed if something is hooked on hook_result, otherwise
+        # heads are computed result_chunk_heads at a time for hook_result_chunk
+        n_heads = self.cfg["n_heads"]
+        if self.hook_result.has_hooks():
+            result = self.hook_result(torch.einsum("imh,bqih->bqim", self.W_O, z))  # [batch, pos, head_index, d_model]
+            if not self.hook_result_chunk.has_hooks():
+                return out + einops.reduce(result, "batch position index model->batch position model", "sum")
+        for start in range(0, n_heads, self.result_chunk_heads):
+            heads = slice(start, min(n_heads, start + self.result_chunk_heads))
+            if self.hook_result.has_hooks():
+                result_chunk = result[:, :, heads]
+            else:
+                result_chunk = torch.einsum("imh,bqih->bqim", self.W_O[heads], z[:, :, heads])
+            self.hook_result_chunk.head_slice = heads
+            result_chunk = self.hook_result_chunk(result_chunk)  # [batch, pos, head_chunk, d_model]
+            out = out + result_chunk.sum(-2)
+        return out
+
+    def get_mask(self, query_pos, key_pos, attention_mask=None):
+        # True iff that query position can attend to that key position
+        mask = self.mask[:query_pos, :key_pos]  # [query_pos, key_pos]
+        if attention_mask is not None:
+            mask = mask & attention_mask[:, None, None, :key_pos].bool()  # [batch, 1, query_pos, key_pos]
+        return mask
+
+    def apply_causal_mask(self, attn_scores, attention_mask=None):
+        mask = self.get_mask(attn_scores.size(-2), attn_scores.size(-1), attention_mask)
+        return torch.where(mask, attn_scores, self.IGNORE)  # type: ignore
 
 
 # Transformer Block
@@ -117,9 +182,9 @@ class AttnOnlyBlock(nn.Module):
         self.hook_resid_pre = HookPoint()  # [batch, pos, d_model]
         self.hook_resid_post = HookPoint()  # [batch, pos, d_model]
 
-    def forward(self, x, pos_embed):
+    def forward(self, x, pos_embed, attention_mask=None):
         resid_pre = self.hook_resid_pre(x)  # [batch, pos, d_model]
-        attn_out = self.hook_attn_out(self.attn(x, pos_embed))  # [batch, pos, d_model]
+        attn_out = self.hook_attn_out(self.attn(x, pos_embed, attention_mask))  # [batch, pos, d_model]
         resid_post = self.hook_resid_post(resid_pre + attn_out)  # [batch, pos, d_model]
         return resid_post
 
@@ -140,34 +205,68 @@ class AttnOnlyTransformer(HookedRootModule):
 
         self.blocks: StaticModuleList[AttnOnlyBlock] = StaticModuleList([AttnOnlyBlock(self.cfg, block_index) for block_index in range(self.cfg["n_layers"])])
         self.unembed = Unembed(self.cfg)
+        self.set_row_major_embed(self.cfg.get("row_major_embed", False))
 
         # Gives each module a parameter with its name (relative to this root module)
         # Needed for HookPoints to work
         self.setup_hooks()
 
-    def forward(self, tokens):
+    def forward(self, tokens, start_at_layer=None, stop_at_layer=None, attention_mask=None):
         # Input x is either a batch of tokens ([batch, pos]) or a text string
-        if type(tokens) == str:
-            # If text, convert to tokens (batch_size=1)
-            tokens = self.to_tokens(tokens)
-        embed = self.hook_embed(self.embed(tokens))  # [batch, pos, d_model]
-        pos_embed = self.hook_pos_embed(self.pos_embed(tokens))  # [batch, pos, d_model]
-        # We do NOT add positional embeddings into the residual stream
-        # Instead they are added into the input of just the query and
-        # key matrices, and not the values or unembed.
-        residual = embed  # [batch, pos, d_model]
-        for block in self.blocks:
+        # If start_at_layer is given, tokens is instead the residual stream going
+        # into that layer ([batch, pos, d_model], eg a cached blocks.{layer}.hook_resid_pre)
+        # and the layers before it are skipped
+        # If stop_at_layer is given, the layers from stop_at_layer on are skipped,
+        # and the residual stream going into that layer is returned instead of logits
+        # attention_mask ([batch, pos]) is 0 for left padding tokens
+        if start_at_layer is None:
+            if type(tokens) == str:
+                # If text, convert to tokens (batch_size=1)
+                tokens = self.to_tokens(tokens)
+            elif isinstance(tokens, list):
+                # A list of strings is left padded, and the padding masked
+                tokens, attention_mask = self.to_tokens(tokens, return_attention_mask=True)
+            embed = self.hook_embed(self.embed(tokens))  # [batch, pos, d_model]
+            pos_embed = self.hook_pos_embed(self.pos_embed(tokens, attention_mask))  # [batch, pos, d_model]
+            # We do NOT add positional embeddings into the residual stream
+            # Instead they are added into the input of just the query and
+            # key matrices, and not the values or unembed.
+            residual = embed  # [batch, pos, d_model]
+        else:
+            residual = tokens  # [batch, pos, d_model]
+            # The positional embeddings only depend on the number of positions
+            pos_embed = self.hook_pos_embed(self.pos_embed(residual[..., 0], attention_mask))  # [batch, pos, d_model]
+        for block in self.blocks[start_at_layer:stop_at_layer]:
             # Note that each block includes skip connections, so we don't need
             # residual + block(residual)
-            residual = block(residual, pos_embed)  # [batch, pos, d_model]
+            residual = block(residual, pos_embed, attention_mask)  # [batch, pos, d_model]
+        if stop_at_layer is not None:
+            return residual  # [batch, pos, d_model]
         logits = self.unembed(residual)  # [batch, pos, d_vocab]
         return logits
 
-    def to_tokens(self, text):
-        return self.tokenizer(
-            self.tokenizer.bos_token + text,
-            return_tensors="pt",
-        )["input_ids"]
+    def to_tokens(self, text, return_attention_mask=False):
+        # text is a string, or a list of strings, which are left padded (see
+        # left_pad). If return_attention_mask, also returns the attention mask
+        # to pass to forward, 0 for padding tokens
+        if type(text) == str:
+            text = [text]
+        token_ids = self.tokenizer([self.tokenizer.bos_token + t for t in text])["input_ids"]
+        # Padding is masked out, so it doesn't matter which token it is
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        tokens, attention_mask = left_pad(token_ids, pad_token_id)
+        if return_attention_mask:
+            return tokens, attention_mask
+        return tokens
+
+    def set_row_major_embed(self, row_major_embed: bool):
+        # Toggles storing W_E row-major in memory and looking up tokens with
+        # F.embedding, and computing the logits with a single matrix multiply.
+        # W_E and W_U keep their shapes either way
+        self.embed.set_row_major(row_major_embed)
+        self.unembed.row_major = row_major_embed
 
     def set_attn_result(self, use_attn_result: bool):
         self.cfg["use_attn_result"] = use_attn_result
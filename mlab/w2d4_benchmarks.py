@@ -0,0 +1,583 @@
+# %%
+"""
+CPU benchmarks for the w2d4 transformer implementations.
+
+Each section defines a benchmark function taking an already loaded model, so the
+functions can also be run on a smaller model. Running this file as a script loads
+GPT-2 small on CPU and prints the results.
+"""
+import time
+
+import torch as t
+
+from w2d4_attention import efficient_attention, sliding_window_attention
+from w2d4_easy_transformer import EasyTransformer
+
+MAIN = __name__ == "__main__"
+
+
+def time_fn(fn, n_warmup=2, n_repeats=10):
+    """
+    Returns the median wall time of fn() in seconds
+    """
+    for _ in range(n_warmup):
+        fn()
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+if MAIN:
+    t.set_grad_enabled(False)
+    model = EasyTransformer("gpt2")
+    model.eval()
+
+# %%
+"""
+## Hook point dispatch
+
+Per token forward latency with HookPoints going through nn.Module.__call__, with the
+fast path for idle hook points, and with a (no-op) hook on every hook point.
+"""
+
+
+def benchmark_hook_dispatch(model, batch=1, seq_len=128):
+    tokens = t.randint(0, model.cfg["d_vocab"], (batch, seq_len))
+    n_tokens = batch * seq_len
+    results = {}
+
+    model.set_fast_dispatch(False)
+    results["module dispatch, no hooks"] = time_fn(lambda: model(tokens)) / n_tokens
+    model.set_fast_dispatch(True)
+    results["fast dispatch, no hooks"] = time_fn(lambda: model(tokens)) / n_tokens
+
+    def noop_hook(activation, hook):
+        pass
+
+    for hp in model.hook_points():
+        hp.add_hook(noop_hook)
+    results["fast dispatch, hook on every hook point"] = time_fn(lambda: model(tokens)) / n_tokens
+    model.reset_hooks()
+    return results
+
+
+if MAIN:
+    print(f"{len(model.hook_dict)} hook points")
+    for setting, seconds in benchmark_hook_dispatch(model).items():
+        print(f"{setting}: {seconds * 1e6:.1f} us/token")
+
+# %%
+"""
+## run_with_hooks overhead
+
+Per call overhead of adding and removing hooks, on top of a plain forward pass, for
+GPT-2 medium on a single token (so the forward pass itself is as cheap as possible).
+"Walk every hook point" is the teardown cost if every hook point is visited, as
+reset_hooks used to do.
+"""
+
+
+def benchmark_hook_overhead(model, n_repeats=50):
+    tokens = t.zeros((1, 1), dtype=t.int64)
+
+    def noop_hook(activation, hook):
+        pass
+
+    def walk_every_hook_point():
+        model.run_with_hooks(tokens, fwd_hooks=[("blocks.0.attn.hook_v", noop_hook)], reset_hooks_end=False)
+        model.clear_contexts()
+        model.remove_all_hook_fns()
+
+    def hooks_context():
+        with model.hooks(fwd_hooks=[(lambda name: name.endswith("attn.hook_v"), noop_hook)]):
+            model(tokens)
+
+    plain = time_fn(lambda: model(tokens), n_repeats=n_repeats)
+    settings = {
+        "run_with_hooks, one hook name": lambda: model.run_with_hooks(
+            tokens, fwd_hooks=[("blocks.0.attn.hook_v", noop_hook)]
+        ),
+        "run_with_hooks, new predicate each call": lambda: model.run_with_hooks(
+            tokens, fwd_hooks=[(lambda name: name.endswith("attn.hook_v"), noop_hook)]
+        ),
+        "run_with_hooks, glob (cached)": lambda: model.run_with_hooks(
+            tokens, fwd_hooks=[("blocks.*.attn.hook_v", noop_hook)]
+        ),
+        "hooks context manager, new predicate each call": hooks_context,
+        "walk every hook point": walk_every_hook_point,
+    }
+    return {setting: time_fn(fn, n_repeats=n_repeats) - plain for setting, fn in settings.items()}
+
+
+if MAIN:
+    model_medium = EasyTransformer("gpt2-medium")
+    model_medium.eval()
+    for setting, seconds in benchmark_hook_overhead(model_medium).items():
+        print(f"{setting}: {seconds * 1e6:.0f} us overhead per call")
+    del model_medium
+
+# %%
+"""
+## Generation throughput
+
+Tokens per second generating from GPT-2 small, with and without the key value cache.
+Without the cache every step reruns the whole sequence, so the cost per new token
+grows with the sequence length, while with it each step only runs the newest token.
+
+On a single CPU core, batch 1, a 16 token prompt and 128 new tokens, we got about
+3.3 tokens/s without the cache and about 10 tokens/s with it (the cached steps are
+then dominated by the unembed).
+"""
+
+
+def benchmark_generate(model, batch=1, prompt_len=16, max_new_tokens=128, n_repeats=3):
+    tokens = t.randint(0, model.cfg["d_vocab"], (batch, prompt_len))
+    results = {}
+    for use_past_kv_cache in [False, True]:
+        seconds = time_fn(
+            lambda: model.generate(tokens, max_new_tokens, temperature=0, use_past_kv_cache=use_past_kv_cache),
+            n_warmup=1,
+            n_repeats=n_repeats,
+        )
+        results[f"use_past_kv_cache={use_past_kv_cache}"] = batch * max_new_tokens / seconds
+    return results
+
+
+if MAIN:
+    for setting, tokens_per_second in benchmark_generate(model).items():
+        print(f"{setting}: {tokens_per_second:.1f} tokens/s")
+
+# %%
+"""
+## Fused QKV projection
+
+Latency of a single attention layer of GPT-2 small, computing queries, keys and values
+with three einsums vs one matrix multiply against the packed W_QKV (use_fused_qkv).
+Uses however many threads torch (MKL / OpenMP) is set to use.
+
+On a single CPU thread, batch 8 x 128 positions went from about 60.7 ms to 58.7 ms,
+and a single position from 3.3 ms to 3.1 ms - the projections are only a small
+part of the layer, the attention pattern dominates.
+"""
+
+
+def benchmark_fused_qkv(model, batch=8, seq_len=128, layer=0):
+    attn = model.blocks[layer].attn
+    x = t.randn(batch, seq_len, model.cfg["d_model"])
+    results = {}
+    for use_fused_qkv in [False, True]:
+        model.set_fused_qkv(use_fused_qkv)
+        results[f"use_fused_qkv={use_fused_qkv}"] = time_fn(lambda: attn(x))
+    model.set_fused_qkv(False)
+    return results
+
+
+if MAIN:
+    print(f"{t.get_num_threads()} threads, MKL available: {t.backends.mkl.is_available()}")
+    for setting, seconds in benchmark_fused_qkv(model).items():
+        print(f"{setting}: {seconds * 1e3:.2f} ms per attention layer")
+
+# %%
+"""
+## Memory efficient attention
+
+Forward pass time at full context length, with the efficient attention path (taken
+automatically when nothing is hooked on hook_attn_scores or hook_attn) vs the explicit
+path (forced here with a no-op hook on hook_attn). The explicit path materializes a
+[batch, head_index, query_pos, key_pos] float32 pattern per layer (and a few
+temporaries the same size), which is what stops large batches fitting in memory.
+
+For GPT-2 small on a single CPU thread at batch 2 x 1024 positions, a forward pass
+took 6.7 s efficient vs 10.5 s explicit. At batch 4 x 1024, running the blocks (but
+not the unembed, whose logits dominate otherwise) raised peak memory by 124 MB with
+the efficient path vs 307 MB with the explicit one.
+"""
+
+
+def benchmark_efficient_attention(model, batch=4, seq_len=1024, n_repeats=3):
+    tokens = t.randint(0, model.cfg["d_vocab"], (batch, seq_len))
+    pattern_bytes = 4 * batch * model.cfg["n_heads"] * seq_len**2
+
+    def noop_hook(activation, hook):
+        pass
+
+    results = {"efficient": time_fn(lambda: model(tokens), n_warmup=1, n_repeats=n_repeats)}
+    with model.hooks(fwd_hooks=[("blocks.*.attn.hook_attn", noop_hook)]):
+        results["explicit"] = time_fn(lambda: model(tokens), n_warmup=1, n_repeats=n_repeats)
+    return results, pattern_bytes
+
+
+if MAIN:
+    results, pattern_bytes = benchmark_efficient_attention(model)
+    print(f"Attention pattern per layer: {pattern_bytes / 2**20:.0f} MB")
+    for setting, seconds in results.items():
+        print(f"{setting}: {seconds:.2f} s per forward pass")
+
+# %%
+"""
+## Sliding window attention
+
+A GPT-Neo local attention layer (window of 256) at its full 2048 positions, computing
+dense scores with a banded mask vs only the [block, block + window] tiles the window
+can reach. Uses random queries, keys and values in GPT-Neo 125M's shapes, so it
+doesn't need the model.
+
+On a single CPU thread this took 196 ms dense (with scaled_dot_product_attention)
+vs 125 ms with the sliding window, and the scores take 2048 x 383 rather than
+2048 x 2048 floats per head.
+"""
+
+
+def benchmark_sliding_window(batch=1, seq_len=2048, n_heads=12, d_head=64, window_size=256):
+    q, k, v = t.randn(3, batch, seq_len, n_heads, d_head).unbind(0)
+    ignore = t.tensor(-1e5)
+    positions = t.arange(seq_len)
+    mask = (positions[None, :] <= positions[:, None]) & (positions[None, :] > positions[:, None] - window_size)
+    return {
+        "dense": time_fn(lambda: efficient_attention(q, k, v, mask, 1.0, ignore)),
+        "sliding window": time_fn(lambda: sliding_window_attention(q, k, v, window_size, 1.0, ignore)),
+    }
+
+
+if MAIN:
+    for setting, seconds in benchmark_sliding_window().items():
+        print(f"{setting}: {seconds * 1e3:.0f} ms per local attention layer")
+
+# %%
+"""
+## Reduced precision
+
+Per token loss, forward pass time and weight memory with bfloat16 weights and
+activations, and with int8 weights for the MLPs and unembed (dequantized on the fly),
+compared to float32, for GPT-2 small. The loss changes are per token differences from
+float32 in the next token losses on a fixed piece of text.
+
+The weights take 634 MB in float32, 323 MB in bfloat16, 362 MB with int8 weights and
+232 MB with both. On a single CPU thread, for a 361 token input, a forward pass took
+1.11 s in float32, 0.80 s in bfloat16, 1.17 s with int8 weights and 0.55 s with both
+(bfloat16 only helps on CPUs with native bfloat16 matmuls, eg AVX512-BF16 or AMX).
+
+The loss changes below are for randomly initialised GPT-2 small weights (seed 0), with
+PRECISION_TEXT split into one token per character (361 tokens), as neither the
+pretrained weights nor GPT-2's tokenizer were available where this was measured. The
+random model's outputs are close to uniform (mean loss 11.07), so the changes with
+pretrained weights may well differ.
+
+| setting              | mean change | mean abs change | max abs change |
+|----------------------|-------------|-----------------|----------------|
+| bfloat16             | -0.00073    | 0.0059          | 0.020          |
+| int8 weights         | 0.00061     | 0.0081          | 0.030          |
+| int8 weights, bf16   | -0.00057    | 0.0106          | 0.034          |
+"""
+
+PRECISION_TEXT = (
+    "The Eiffel Tower is a wrought-iron lattice tower on the Champ de Mars in Paris, France. "
+    "It is named after the engineer Gustave Eiffel, whose company designed and built the tower. "
+    "Locally nicknamed La dame de fer, it was constructed from 1887 to 1889 as the centerpiece "
+    "of the 1889 World's Fair, and to crown the centennial anniversary of the French Revolution."
+)
+
+
+def model_bytes(model):
+    return sum(t.nelement() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def benchmark_precision(model_name, text=PRECISION_TEXT, weight_cache_dir=None):
+    from w2d4_losses import per_token_losses
+
+    settings = {
+        "float32": {},
+        "bfloat16": {"dtype": t.bfloat16},
+        "int8 weights": {"int8_weights": True},
+        "int8 weights, bfloat16": {"int8_weights": True, "dtype": t.bfloat16},
+    }
+    results = {}
+    for setting, kwargs in settings.items():
+        model = EasyTransformer(model_name, weight_cache_dir=weight_cache_dir, **kwargs)
+        tokens = model.to_tokens(text)
+        losses = per_token_losses(model(tokens).float(), tokens)
+        if setting == "float32":
+            reference_losses = losses
+        results[setting] = {
+            "mean loss": losses.mean().item(),
+            "mean loss change": (losses - reference_losses).mean().item(),
+            "mean abs per token loss change": (losses - reference_losses).abs().mean().item(),
+            "max abs per token loss change": (losses - reference_losses).abs().max().item(),
+            "seconds per forward": time_fn(lambda: model(tokens), n_repeats=5),
+            "weight MB": model_bytes(model) / 2**20,
+        }
+        del model
+    return results
+
+
+if MAIN:
+    for setting, stats in benchmark_precision("gpt2").items():
+        print(setting, ", ".join(f"{name}: {value:.4g}" for name, value in stats.items()))
+
+# %%
+"""
+## Compiled forward pass
+
+Tokens per second scoring batches with the eager forward pass vs the one compiled by
+compile_forward (used automatically while no hooks are attached). Compilation time
+is excluded (it happens in the warmup calls).
+
+For GPT-2 small on a single CPU thread, batch 8 x 128 went from about 310 to 385
+tokens/s, and batch 1 x 32 from about 165 to 215 tokens/s.
+"""
+
+
+def benchmark_compiled_forward(model, batch=8, seq_len=128, n_repeats=5):
+    tokens = t.randint(0, model.cfg["d_vocab"], (batch, seq_len))
+    results = {"eager": batch * seq_len / time_fn(lambda: model.run_forward(tokens), n_repeats=n_repeats)}
+    model.compile_forward()
+    results["compiled"] = batch * seq_len / time_fn(lambda: model(tokens), n_repeats=n_repeats)
+    model.compiled_forward = None
+    return results
+
+
+if MAIN:
+    for setting, tokens_per_second in benchmark_compiled_forward(model).items():
+        print(f"{setting}: {tokens_per_second:.0f} tokens/s")
+
+# %%
+"""
+## Chunked vocab loss
+
+Per token loss from logits (computing the full [batch, pos, d_vocab] logits, then their
+log softmax) vs forward with return_type="loss", which runs the unembed a vocab chunk
+at a time and never materializes the logits.
+
+For GPT-2 small on a single CPU thread at batch 4 x 512 (393 MB of logits), peak memory
+rose by 1342 MB with the full logits vs 192 MB chunked, and a forward pass took 7.4 s
+vs 5.9 s.
+"""
+
+
+def benchmark_chunked_loss(model, batch=4, seq_len=512, n_repeats=3):
+    from w2d4_losses import per_token_losses
+
+    tokens = t.randint(0, model.cfg["d_vocab"], (batch, seq_len))
+    logits_bytes = 4 * batch * seq_len * model.cfg["d_vocab"]
+    results = {
+        "full logits": time_fn(lambda: per_token_losses(model(tokens), tokens), n_warmup=1, n_repeats=n_repeats),
+        "chunked vocab": time_fn(lambda: model(tokens, return_type="loss"), n_warmup=1, n_repeats=n_repeats),
+    }
+    return results, logits_bytes
+
+
+if MAIN:
+    results, logits_bytes = benchmark_chunked_loss(model)
+    print(f"Logits: {logits_bytes / 2**20:.0f} MB")
+    for setting, seconds in results.items():
+        print(f"{setting}: {seconds:.2f} s per forward pass")
+
+# %%
+"""
+## Row-major embedding
+
+Time for the embed and the unembed with W_E gathered as strided columns then transposed,
+and the unembed as an einsum, vs with row_major_embed (W_E stored row-major and looked
+up with F.embedding, the unembed a single addmm). The embed runs on batch 64 x 1024
+tokens. The unembed runs on fewer positions, since logits for 64 x 1024 positions of
+GPT-2 would take 13 GB.
+
+For GPT-2 small on a single CPU thread, the embed went from about 459 ms to 167 ms, and
+the unembed of 1024 positions from about 926 ms to 817 ms.
+"""
+
+
+def benchmark_row_major_embed(model, batch=64, seq_len=1024, unembed_positions=1024, n_repeats=5):
+    tokens = t.randint(0, model.cfg["d_vocab"], (batch, seq_len))
+    residual = t.randn(1, unembed_positions, model.cfg["d_model"])
+    results = {}
+    for row_major_embed in [False, True]:
+        model.set_row_major_embed(row_major_embed)
+        results[f"row_major_embed={row_major_embed}, embed"] = time_fn(lambda: model.embed(tokens), n_repeats=n_repeats)
+        results[f"row_major_embed={row_major_embed}, unembed"] = time_fn(
+            lambda: model.unembed(residual), n_repeats=n_repeats
+        )
+    model.set_row_major_embed(False)
+    return results
+
+
+if MAIN:
+    for setting, seconds in benchmark_row_major_embed(model).items():
+        print(f"{setting}: {seconds * 1e3:.1f} ms")
+
+# %%
+"""
+## Composition scores
+
+Time for the Q, K and V composition scores between every pair of heads in different
+layers with composition_scores (from the low rank factors), vs the time for a single
+pair of layers with the einsums of get_q_comp_scores etc in w2d4_solution, which form
+[n_heads, n_heads, d_model, d_model] products.
+
+For GPT-2 small on a single CPU thread, the einsums took 4.8 s (and 3 x 576 MB) for one
+pair of layers, while composition_scores took 2.7 s for all 66 pairs. For GPT-2 medium
+(276 pairs of layers) composition_scores took about 22 s.
+"""
+
+
+def benchmark_composition_scores(model):
+    from w2d4_circuits import composition_scores, frobenius_norm
+
+    def one_layer_pair_einsums():
+        attn_0, attn_1 = model.blocks[0].attn, model.blocks[1].attn
+        W_OV_0 = t.einsum("imh,ihM->imM", attn_0.W_O, attn_0.W_V)
+        W_QK = t.einsum("ihm,ihM->imM", attn_1.W_Q, attn_1.W_K)
+        W_OV_1 = t.einsum("imh,ihM->imM", attn_1.W_O, attn_1.W_V)
+        for full in [
+            t.einsum("Imn,imM->IinM", W_QK, W_OV_0),
+            t.einsum("Inm,imM->IinM", W_QK, W_OV_0),
+            t.einsum("Inm,imM->IinM", W_OV_1, W_OV_0),
+        ]:
+            frobenius_norm(full)
+
+    return {
+        "einsums, one pair of layers": time_fn(one_layer_pair_einsums, n_warmup=0, n_repeats=1),
+        "composition_scores, all pairs of layers": time_fn(lambda: composition_scores(model), n_warmup=0, n_repeats=1),
+    }
+
+
+if MAIN:
+    for setting, seconds in benchmark_composition_scores(model).items():
+        print(f"{setting}: {seconds:.1f} s")
+
+# %%
+"""
+## Random composition score baseline
+
+Milliseconds per random composition score in GPT-2 small's shapes, one at a time like
+generate_single_random_comp_score in w2d4_solution (which forms the [d_model, d_model]
+products), vs in batches with composition_baseline.
+
+On a single CPU thread this went from about 14 ms to 2.0 ms per score, three quarters
+of which is drawing the random factors. 10^5 samples took 197 s for GPT-2 small's
+shapes, with peak memory about 130 MB above the baseline (mostly the 100 MB buffer the
+factors are drawn into), and the time scales down with more threads.
+"""
+
+
+def benchmark_composition_baseline(d_model=768, d_head=64, n_looped=100, n_batched=10240):
+    from w2d4_circuits import composition_baseline, frobenius_norm
+
+    def single_random_comp_score():
+        matrices = [t.empty((d_head, d_model)) for i in range(4)]
+        for mat in matrices:
+            t.nn.init.kaiming_uniform_(mat, a=5**0.5)
+        W1 = matrices[0].T @ matrices[1]
+        W2 = matrices[2].T @ matrices[3]
+        W3 = W1 @ W2
+        return (frobenius_norm(W3) / frobenius_norm(W1) / frobenius_norm(W2)).item()
+
+    looped = time_fn(lambda: [single_random_comp_score() for _ in range(n_looped)], n_warmup=0, n_repeats=1)
+    batched = time_fn(lambda: composition_baseline(d_model, d_head, n_batched), n_warmup=0, n_repeats=1)
+    return {"one at a time": looped / n_looped, "batched": batched / n_batched}
+
+
+if MAIN:
+    for setting, seconds in benchmark_composition_baseline().items():
+        print(f"{setting}: {seconds * 1e3:.2f} ms per score")
+
+# %%
+"""
+## Factored full circuits
+
+Top-1 accuracy of a rank 64 vocab x vocab circuit (random factors), by forming the dense
+matrix and taking column argmaxes as top_1_acc in w2d4_solution does, vs with
+FactoredCircuit, which only ever holds block_size columns (per thread). The dense
+matrix for GPT-2's vocab would take 10 GB, so that's only timed for a smaller vocab.
+
+On a single CPU thread, for a vocab of 16384 the dense version took 6.9 s (and a 1 GB
+matrix) vs 2.3 s factored. For GPT-2's vocab of 50257 the factored version took 24 s,
+holding about 250 MB per block of 1024 columns.
+"""
+
+
+def benchmark_factored_circuit(d_vocab=50257, dense_d_vocab=16384, rank=64, d_model=768, n_threads=1):
+    from w2d4_circuits import FactoredCircuit
+
+    def factors(n):
+        return t.randn(n, d_model), t.randn(d_model, rank), t.randn(rank, d_model), t.randn(d_model, n)
+
+    def dense_top_1(W_U, W_O, W_V, W_E):
+        circuit = W_U @ W_O @ W_V @ W_E
+        return (circuit.argmax(0) == t.arange(circuit.size(1))).float().mean()
+
+    small = factors(dense_d_vocab)
+    return {
+        f"dense, d_vocab={dense_d_vocab}": time_fn(lambda: dense_top_1(*small), n_warmup=0, n_repeats=1),
+        f"factored, d_vocab={dense_d_vocab}": time_fn(
+            lambda: FactoredCircuit.from_product(*small, n_threads=n_threads).top_k_accuracy(), n_warmup=0, n_repeats=1
+        ),
+        f"factored, d_vocab={d_vocab}": time_fn(
+            lambda: FactoredCircuit.from_product(*factors(d_vocab), n_threads=n_threads).top_k_accuracy(),
+            n_warmup=0,
+            n_repeats=1,
+        ),
+    }
+
+
+if MAIN:
+    for setting, seconds in benchmark_factored_circuit().items():
+        print(f"{setting}: {seconds:.1f} s")
+
+# %%
+"""
+## Decomposed attention score statistics
+
+Time and peak memory for the standard deviation of each pair of components' attention
+scores, for every head of the last layer of GPT-2 small (2 embeddings, 132 earlier heads,
+11 MLPs and the attention biases, 146 components) on a sequence of seq_len tokens:
+materializing decompose_attn_scores as in w2d4_solution one head at a time, vs
+decomposed_score_stats for all heads at once.
+
+On a single CPU thread with seq_len=64 the dense version took 17.7 s, materializing
+354 MB of scores per head, vs 12.3 s. Most of what's left is computing the scores for
+the min and max, as the mean and variance come from the queries' and keys' covariances.
+With seq_len=128 the dense version (1.4 GB per head) ran out of memory on a 5 GB
+machine, while decomposed_score_stats took 50 s (29 s with causal=True) using a few
+hundred MB.
+"""
+
+
+def benchmark_decomposed_score_stats(model, seq_len=128):
+    from w2d4_circuits import decompose_attn_input, decompose_qk, decomposed_score_stats
+
+    layer = model.cfg["n_layers"] - 1
+    tokens = t.randint(0, model.cfg["d_vocab"], (1, seq_len))
+    cache = {}
+    use_attn_result = model.cfg["use_attn_result"]
+    model.cfg["use_attn_result"] = True  # For blocks.*.attn.hook_result
+    with t.inference_mode():
+        model.cache_all(cache)
+        model(tokens)
+        model.reset_hooks()
+        model.cfg["use_attn_result"] = use_attn_result
+        components, _ = decompose_attn_input(model, cache, layer)
+        attn = model.blocks[layer].attn
+        decomposed_q, decomposed_k = decompose_qk(components, attn.W_Q, attn.W_K, attn.b_Q, attn.b_K)
+
+        def dense():
+            for head in range(decomposed_q.size(0)):
+                scores = t.einsum("cqh,Ckh->cCqk", decomposed_q[head], decomposed_k[head]) / attn.attn_scale
+                scores.flatten(-2).std(-1)
+
+        return {
+            "dense, one head at a time": time_fn(dense, n_warmup=0, n_repeats=1),
+            "decomposed_score_stats": time_fn(
+                lambda: decomposed_score_stats(decomposed_q, decomposed_k, attn_scale=attn.attn_scale),
+                n_warmup=0,
+                n_repeats=1,
+            ),
+        }
+
+
+if MAIN:
+    for setting, seconds in benchmark_decomposed_score_stats(model).items():
+        print(f"{setting}: {seconds:.1f} s")
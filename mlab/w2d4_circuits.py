@@ -0,0 +1,491 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+COMPOSITION_TYPES = ["q", "k", "v"]
+
+
+def head_weights(model):
+    # Stacks the attention weights of every layer of model (an EasyTransformer or
+    # AttnOnlyTransformer) in float32: W_Q, W_K and W_V are
+    # [n_layers, n_heads, d_head, d_model], W_O is [n_layers, n_heads, d_model, d_head]
+    attns = [block.attn for block in model.blocks]
+    return tuple(
+        torch.stack([getattr(attn, name).detach().float() for attn in attns]) for name in ["W_Q", "W_K", "W_V", "W_O"]
+    )
+
+
+def frobenius_norm(tensor):
+    # As in w2d4_solution, the sum of squared elements over the last two dimensions
+    return tensor.pow(2).sum([-2, -1])
+
+
+def triangular_factor(W):
+    # R ([..., d_head, d_head]) from the QR decomposition W = QR of a tall
+    # W ([..., d_model, d_head]). Q has orthonormal columns, so for any X the
+    # norm of W @ X equals that of R @ X (and of X @ W.T that of X @ R.T), which
+    # moves norms of products of head matrices into d_head sized space
+    return torch.linalg.qr(W, mode="r")[1]
+
+
+def composition_factors(W_Q, W_K, W_V, W_O):
+    """
+    Factors of the composition scores of heads with the given weights (with any
+    leading batch dimensions, eg [n_layers, n_heads]), such that for an earlier
+    head A and a later head B the numerator of the score is
+    frobenius_norm(read[B] @ write[A]), with read[B] [d_head, d_model] and
+    write[A] [d_model, d_head]:
+
+    Q-composition: |W_QK^T W_OV| = |W_K^T W_Q W_O W_V| = |(R_K W_Q) (W_O R_V^T)|
+    K-composition: |W_QK W_OV| = |W_Q^T W_K W_O W_V| = |(R_Q W_K) (W_O R_V^T)|
+    V-composition: |W_OV' W_OV| = |W_O' W_V' W_O W_V| = |(R_O' W_V') (W_O R_V^T)|
+
+    where W_K^T = Q_K R_K etc are QR decompositions (see triangular_factor).
+    The norms in the denominators similarly come from [d_head, d_head] products,
+    |W_QK| = |R_Q R_K^T| and |W_OV| = |R_O R_V^T|.
+
+    Returns read (a dict from composition type to the read factors), write, and
+    norms (a dict with the W_QK and W_OV norms)
+    """
+    R_Q = triangular_factor(W_Q.transpose(-1, -2))
+    R_K = triangular_factor(W_K.transpose(-1, -2))
+    R_V = triangular_factor(W_V.transpose(-1, -2))
+    R_O = triangular_factor(W_O)
+    read = {"q": R_K @ W_Q, "k": R_Q @ W_K, "v": R_O @ W_V}  # [..., d_head, d_model]
+    write = W_O @ R_V.transpose(-1, -2)  # [..., d_model, d_head]
+    norms = {
+        "W_QK": frobenius_norm(R_Q @ R_K.transpose(-1, -2)),
+        "W_OV": frobenius_norm(R_O @ R_V.transpose(-1, -2)),
+    }
+    return read, write, norms
+
+
+def composition_scores(model, comp_types=COMPOSITION_TYPES, max_block_elements=2**24):
+    """
+    Q, K and V composition scores (as get_q_comp_scores etc in w2d4_solution)
+    between every pair of heads in different layers of model, computed from the
+    low rank factors of W_QK and W_OV (see composition_factors), so the
+    [d_model, d_model] matrices are never formed.
+
+    All heads are scored against all earlier heads with one matrix multiply per
+    later layer, [n_heads * d_head, d_model] @ [d_model, n_earlier_heads * d_head],
+    split along the earlier heads so no block has more than about
+    max_block_elements elements.
+
+    Returns a dict from composition type ("q", "k" or "v") to a
+    [n_layers, n_heads, n_layers, n_heads] tensor, where scores[l, h, l_0, h_0]
+    is the score from head h_0 of layer l_0 to head h of layer l, and is 0
+    unless l_0 < l.
+    """
+    W_Q, W_K, W_V, W_O = head_weights(model)
+    n_layers, n_heads, d_head, d_model = W_Q.shape
+    read, write, norms = composition_factors(W_Q, W_K, W_V, W_O)
+    # [d_model, n_layers, n_heads, d_head], so earlier heads are columns
+    write = write.permute(2, 0, 1, 3)
+    layers_per_block = max(1, max_block_elements // (n_heads * d_head) ** 2)
+
+    scores = {comp_type: W_Q.new_zeros(n_layers, n_heads, n_layers, n_heads) for comp_type in comp_types}
+    for comp_type in comp_types:
+        # The later head's norm: W_QK for Q and K composition, W_OV for V
+        read_norms = norms["W_OV"] if comp_type == "v" else norms["W_QK"]  # [n_layers, n_heads]
+        for layer in range(1, n_layers):
+            read_layer = read[comp_type][layer].reshape(n_heads * d_head, d_model)
+            for start in range(0, layer, layers_per_block):
+                stop = min(layer, start + layers_per_block)
+                write_block = write[:, start:stop].reshape(d_model, -1)
+                products = (read_layer @ write_block).view(n_heads, d_head, stop - start, n_heads, d_head)
+                numerators = products.pow(2).sum([1, 4])  # [n_heads, earlier layer, n_heads]
+                scores[comp_type][layer, :, start:stop] = (
+                    numerators / read_norms[layer][:, None, None] / norms["W_OV"][start:stop][None]
+                )
+    return scores
+
+
+class RunningStats:
+    """
+    Count, mean, variance, min and max of a stream of batches of samples,
+    merging each batch into the totals (Chan et al's parallel form of Welford's
+    algorithm), so the samples themselves never need to be kept. Statistics are
+    kept per element of shape, eg per pair of heads.
+    """
+
+    def __init__(self, shape=(), device=None):
+        self.count = 0
+        self.mean = torch.zeros(shape, device=device)
+        self.m2 = torch.zeros(shape, device=device)  # Sum of squared differences from the mean
+        self.min = torch.full(shape, float("inf"), device=device)
+        self.max = torch.full(shape, float("-inf"), device=device)
+
+    def update(self, samples):
+        # samples: [n, *shape]
+        n = samples.size(0)
+        if n == 0:
+            return
+        samples = samples.float()
+        batch_mean = samples.mean(0)
+        self.merge(n, batch_mean, (samples - batch_mean).pow(2).sum(0))
+        self.update_range(samples.amin(0), samples.amax(0))
+
+    def merge(self, count, mean, m2):
+        # Merges in the mean and variance of count more samples, given their mean
+        # and sum of squared differences from it
+        if count == 0:
+            return
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta.pow(2) * (self.count * count / total)
+        self.count = total
+
+    def update_range(self, min, max):
+        self.min = torch.minimum(self.min, min)
+        self.max = torch.maximum(self.max, max)
+
+    def var(self):
+        # The population variance, like np.var
+        return self.m2 / self.count
+
+    def std(self):
+        return self.var().sqrt()
+
+
+def random_composition_scores(n_samples, d_model, d_head, batch_size=128, generator=None):
+    """
+    Yields batches of composition scores |W_A W_B| / |W_A| |W_B| for random
+    low rank W_A = A_1^T A_2 and W_B = B_1^T B_2, like
+    generate_single_random_comp_score in w2d4_solution but batch_size scores at a
+    time, n_samples in total.
+
+    The four [d_head, d_model] factors are drawn from Kaiming uniform
+    initialisation (with a = sqrt(5), as nn.Linear uses), ie uniform on
+    +-1 / sqrt(d_model). The norms only need the [d_head, d_head] Gram matrices
+    G = X X^T of the factors and M = A_2 B_1^T:
+    |W_A W_B| = sum(M * (G_A1 M G_B2)), |W_A| = sum(G_A1 * G_A2), |W_B| = sum(G_B1 * G_B2)
+
+    On CPU most of the time goes on drawing the random numbers (4 * d_head * d_model
+    per score), not on the scores themselves. They're drawn into one buffer,
+    reused for every batch, of 16 * batch_size * d_head * d_model bytes (about
+    100 MB for GPT-2 small's shapes with the default batch_size)
+    """
+    bound = 1 / d_model**0.5
+    buffer = torch.empty(4, min(batch_size, n_samples), d_head, d_model)
+    for start in range(0, n_samples, batch_size):
+        n = min(batch_size, n_samples - start)
+        factors = buffer[:, :n].uniform_(-bound, bound, generator=generator)
+        A_1, A_2, B_1, B_2 = factors.unbind(0)  # [n, d_head, d_model]
+        G_A1, G_A2, G_B1, G_B2 = (factors @ factors.transpose(-1, -2)).unbind(0)  # [n, d_head, d_head]
+        M = A_2 @ B_1.transpose(-1, -2)  # [n, d_head, d_head]
+        numerators = (M * (G_A1 @ M @ G_B2)).sum([-2, -1])
+        yield numerators / (G_A1 * G_A2).sum([-2, -1]) / (G_B1 * G_B2).sum([-2, -1])
+
+
+def composition_baseline(
+    d_model,
+    d_head,
+    n_samples=100_000,
+    batch_size=128,
+    quantiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99),
+    max_quantile_samples=100_000,
+    generator=None,
+):
+    """
+    Statistics of the composition scores of random heads (see
+    random_composition_scores), to compare real composition scores against.
+    The mean, std, min and max are over all n_samples scores, accumulated batch by
+    batch with RunningStats. The quantiles are of the first max_quantile_samples
+    scores, which (as the samples are independent) are a random sample of them
+    all, so memory doesn't grow with n_samples.
+
+    Returns a dict with mean, std, min, max and quantiles (a dict from each
+    quantile to its value)
+    """
+    stats = RunningStats()
+    kept = []
+    n_kept = 0
+    for scores in random_composition_scores(n_samples, d_model, d_head, batch_size, generator):
+        stats.update(scores)
+        if n_kept < max_quantile_samples:
+            kept.append(scores[: max_quantile_samples - n_kept])
+            n_kept += len(kept[-1])
+    values = torch.quantile(torch.cat(kept), torch.tensor(quantiles))
+    return {
+        "mean": stats.mean.item(),
+        "std": stats.std().item(),
+        "min": stats.min.item(),
+        "max": stats.max.item(),
+        "quantiles": dict(zip(quantiles, values.tolist())),
+    }
+
+
+class FactoredCircuit:
+    """
+    A big low rank matrix, eg a [d_vocab, d_vocab] full circuit like
+    W_U W_O W_V W_E, kept as factors left [n_rows, rank] and right
+    [rank, n_cols] (eg W_U W_O and W_V W_E), with statistics of its columns
+    computed without ever forming it.
+
+    Statistics are computed block_size columns at a time, each block
+    [n_rows, block_size] reduced to a few numbers per column before the next is
+    computed. With n_threads > 1, that many blocks are computed in parallel (the
+    matrix multiplies and reductions release the GIL), so at most n_threads
+    blocks are in memory at once.
+
+    Following top_1_acc in w2d4_solution, each column is an input token, and its
+    entries the scores of each output token, so a column "gets it right" if its
+    largest entry is on the diagonal.
+    """
+
+    def __init__(self, left, right, block_size=1024, n_threads=1):
+        if left.size(1) != right.size(0):
+            raise ValueError(f"Factors of shapes {list(left.shape)} and {list(right.shape)} can't be multiplied")
+        self.left = left.detach().float()
+        self.right = right.detach().float()
+        self.block_size = block_size
+        self.n_threads = n_threads
+        self.stats = None
+
+    @classmethod
+    def from_product(cls, *matrices, **kwargs):
+        # The product of matrices (eg W_U, W_O, W_V, W_E), split at the
+        # narrowest inner dimension, with each side multiplied out
+        split = min(range(1, len(matrices)), key=lambda i: matrices[i].size(0))
+        left, right = matrices[:split], matrices[split:]
+        left = left[0] if len(left) == 1 else torch.linalg.multi_dot(left)
+        right = right[0] if len(right) == 1 else torch.linalg.multi_dot(right)
+        return cls(left, right, **kwargs)
+
+    @property
+    def shape(self):
+        return (self.left.size(0), self.right.size(1))
+
+    @property
+    def T(self):
+        return FactoredCircuit(self.right.T, self.left.T, self.block_size, self.n_threads)
+
+    def column_block(self, start, stop):
+        # Columns start to stop of the full matrix, transposed to [stop - start, n_rows]
+        # so reductions over a column run over contiguous memory (about twice as fast)
+        return self.right[:, start:stop].T @ self.left.T
+
+    def block_stats(self, start):
+        stop = min(self.shape[1], start + self.block_size)
+        block = self.column_block(start, stop)  # [block, n_rows]
+        columns = torch.arange(stop - start, device=block.device)
+        diagonal = block[columns, start + columns]  # [block]
+        max_values, argmax = block.max(-1)
+        # The number of entries in the column bigger than the diagonal one, so 0
+        # if the diagonal is the largest
+        diagonal_rank = (block > diagonal[:, None]).sum(-1, dtype=torch.int32)
+        return diagonal_rank, max_values, argmax
+
+    def column_stats(self):
+        """
+        Returns (and caches) a dict of [n_cols] tensors, for each column:
+            diagonal_rank: How many entries are larger than the diagonal one
+            max: The largest entry
+            argmax: The row of the largest entry
+        Only for square matrices, as it needs the diagonal
+        """
+        if self.stats is None:
+            if self.shape[0] != self.shape[1]:
+                raise ValueError(f"Diagonal statistics need a square matrix, not {list(self.shape)}")
+            starts = range(0, self.shape[1], self.block_size)
+            if self.n_threads > 1:
+                with ThreadPoolExecutor(self.n_threads) as executor:
+                    blocks = list(executor.map(self.block_stats, starts))
+            else:
+                blocks = [self.block_stats(start) for start in starts]
+            diagonal_rank, max_values, argmax = (torch.cat(stat) for stat in zip(*blocks))
+            self.stats = {"diagonal_rank": diagonal_rank, "max": max_values, "argmax": argmax}
+        return self.stats
+
+    def top_k_accuracy(self, k=1):
+        # The fraction of columns whose diagonal entry is among their k largest
+        # (top_1_acc in w2d4_solution is k=1)
+        return (self.column_stats()["diagonal_rank"] < k).float().mean().item()
+
+    def diagonal_rank_stats(self):
+        # Summary statistics of the rank of the diagonal entry within each column (0 is the largest)
+        ranks = self.column_stats()["diagonal_rank"].float()
+        return {
+            "mean": ranks.mean().item(),
+            "median": ranks.median().item(),
+            "top_1_accuracy": self.top_k_accuracy(1),
+            "top_5_accuracy": self.top_k_accuracy(5),
+        }
+
+
+def decompose_attn_input(model, cache, layer, batch_index=0):
+    """
+    Splits the input to the attention of an EasyTransformer's layer (after
+    ln1) into the contributions of each component of the residual stream,
+    like decompose_qk_input in w2d4_solution: the token and positional
+    embeddings, each earlier head's result, each earlier MLP, and the sum of the
+    earlier attention output biases. LayerNormPre centers (which is linear) and
+    divides by a per position scale, which is read from the cache, so the
+    components sum to the normalized input.
+
+    cache: Activations from running model (built with use_attn_result=True) on
+        a batch, including hook_embed, hook_pos_embed, blocks.*.attn.hook_result,
+        blocks.*.hook_attn_out, blocks.*.hook_mlp_out and blocks.*.ln1.hook_scale
+
+    Returns the components, [n_components, pos, d_model], and a label for each
+    """
+    pos_embed = cache["hook_pos_embed"]
+    if pos_embed.dim() == 3:
+        pos_embed = pos_embed[batch_index]
+    components = [cache["hook_embed"][batch_index], pos_embed.expand_as(cache["hook_embed"][batch_index])]
+    labels = ["Embed", "PosEmbed"]
+    attn_bias = torch.zeros_like(components[0])
+    for earlier_layer in range(layer):
+        results = cache[f"blocks.{earlier_layer}.attn.hook_result"][batch_index]  # [pos, head_index, d_model]
+        components.extend(results.unbind(1))
+        labels.extend(f"L{earlier_layer}H{head}" for head in range(results.size(1)))
+        attn_bias = attn_bias + cache[f"blocks.{earlier_layer}.hook_attn_out"][batch_index] - results.sum(1)
+    for earlier_layer in range(layer):
+        components.append(cache[f"blocks.{earlier_layer}.hook_mlp_out"][batch_index])
+        labels.append(f"L{earlier_layer}MLP")
+    if layer > 0:
+        components.append(attn_bias)
+        labels.append("AttnBias")
+    components = torch.stack(components)  # [n_components, pos, d_model]
+    scale = cache[f"blocks.{layer}.ln1.hook_scale"][batch_index]  # [pos, 1]
+    return (components - components.mean(-1, keepdim=True)) / scale, labels
+
+
+def decompose_qk(components, W_Q, W_K, b_Q=None, b_K=None):
+    """
+    The contribution of each component ([n_components, pos, d_model]) to the
+    queries and keys of every head of a layer (W_Q and W_K
+    [n_heads, d_head, d_model]), like decompose_q and decompose_k in
+    w2d4_solution. If given, b_Q and b_K ([n_heads, d_head]) are added as a last
+    component on their side.
+
+    Returns decomposed_q and decomposed_k, [n_heads, n_components, pos, d_head]
+    """
+    decomposed_q = torch.einsum("cpm,ihm->icph", components, W_Q)
+    decomposed_k = torch.einsum("cpm,ihm->icph", components, W_K)
+    pos = components.size(1)
+    if b_Q is not None:
+        decomposed_q = torch.cat([decomposed_q, b_Q[:, None, None, :].expand(-1, 1, pos, -1)], dim=1)
+    if b_K is not None:
+        decomposed_k = torch.cat([decomposed_k, b_K[:, None, None, :].expand(-1, 1, pos, -1)], dim=1)
+    return decomposed_q, decomposed_k
+
+
+def position_moments(x):
+    """
+    Count, mean and sum of outer products of differences from the mean of x
+    ([..., pos, d_head]) over positions: n, [..., d_head] and [..., d_head, d_head]
+    """
+    mean = x.mean(-2)
+    centred = x - mean.unsqueeze(-2)
+    return x.size(-2), mean, centred.transpose(-1, -2) @ centred
+
+
+def merge_position_moments(a, b):
+    # position_moments of the positions of a and b together
+    (n_a, mean_a, m2_a), (n_b, mean_b, m2_b) = a, b
+    if n_a == 0:
+        return b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * (n_b / n), m2_a + m2_b + delta[..., :, None] * delta[..., None, :] * (n_a * n_b / n)
+
+
+def score_moments(q_moments, k_moments):
+    """
+    Count, mean and sum of squared differences from the mean of q . k over every
+    pair of a query and a key, [head_index, query_component, key_component],
+    from position_moments of the queries ([head_index, query_component, pos, d_head])
+    and keys ([head_index, key_component, pos, d_head]).
+
+    Writing q = mu_q + q' and k = mu_k + k', where q' and k' have mean 0, the
+    cross terms have mean 0 and
+    Var(q . k) = <Cov(q), Cov(k)> + mu_k^T Cov(q) mu_k + mu_q^T Cov(k) mu_q,
+    a sum of non-negative terms (so there's no cancellation)
+    """
+    n_q, mean_q, m2_q = q_moments
+    n_k, mean_k, m2_k = k_moments
+    mean = torch.einsum("ich,iCh->icC", mean_q, mean_k)
+    m2 = (
+        torch.einsum("icgh,iCgh->icC", m2_q, m2_k)
+        + torch.einsum("iCg,icgh,iCh->icC", mean_k, m2_q, mean_k) * n_k
+        + torch.einsum("icg,iCgh,ich->icC", mean_q, m2_k, mean_q) * n_q
+    )
+    return n_q * n_k, mean, m2
+
+
+def decomposed_score_stats(
+    decomposed_q, decomposed_k, attn_scale=None, causal=False, max_tile_elements=2**24, stats=None
+):
+    """
+    Statistics over query and key positions of the decomposed attention scores
+    of every head of a layer, ie of decompose_attn_scores in w2d4_solution,
+    scores[head, query_component, key_component, query_pos, key_pos]
+    = decomposed_q[head, query_component, query_pos] . decomposed_k[head, key_component, key_pos] / attn_scale,
+    without ever materializing that tensor.
+
+    The mean and variance of the scores over a block of queries by a block of
+    keys follow from the mean and covariance of the queries and of the keys
+    (see score_moments), so only the min and max need the scores themselves.
+    These are computed for a tile of query positions by a tile of key positions
+    at a time, with tiles sized so each has at most about max_tile_elements
+    elements. With causal, the queries in a tile all see the same keys except
+    for a triangle on the diagonal, whose scores are merged in directly.
+
+    decomposed_q, decomposed_k: [n_heads, n_components, pos, d_head], eg from decompose_qk
+    attn_scale (float): What the scores are divided by, sqrt(d_head) by default
+    causal (bool): If True, only pairs with key_pos <= query_pos count (the
+        notebook doesn't mask, so by default every pair does)
+    stats: A RunningStats from an earlier call to add to, eg to accumulate
+        statistics over several sequences
+
+    Returns a RunningStats of shape [n_heads, n_query_components, n_key_components],
+    whose mean, std(), min and max are over position pairs. The largest
+    contribution of a pair of components is max(stats.max, -stats.min)
+    """
+    decomposed_q, decomposed_k = decomposed_q.float(), decomposed_k.float()
+    n_heads, n_q_components, query_pos, d_head = decomposed_q.shape
+    n_k_components, key_pos = decomposed_k.shape[1:3]
+    if attn_scale is None:
+        attn_scale = d_head**0.5
+    if stats is None:
+        stats = RunningStats((n_heads, n_q_components, n_k_components), device=decomposed_q.device)
+    tile_size = max(1, int((max_tile_elements / (n_heads * n_q_components * n_k_components)) ** 0.5))
+    offset = key_pos - query_pos  # The queries are the last query_pos positions
+
+    def merge_scores(q_moments, k_moments):
+        count, mean, m2 = score_moments(q_moments, k_moments)
+        stats.merge(count, mean / attn_scale, m2 / attn_scale**2)
+
+    def score_tile(q_start, q_stop, k_start, k_stop):
+        scores = torch.einsum(
+            "icqh,iCkh->icCqk",
+            decomposed_q[:, :, q_start:q_stop],
+            decomposed_k[:, :, k_start:k_stop],
+        )
+        return scores.flatten(-2) / attn_scale  # [head_index, query_component, key_component, query tile * key tile]
+
+    if not causal:
+        merge_scores(position_moments(decomposed_q), position_moments(decomposed_k))
+    key_moments = (0, None, None)  # Of the keys every query so far can see
+    for q_start in range(0, query_pos, tile_size):
+        q_stop = min(query_pos, q_start + tile_size)
+        # Keys every query in the tile can see
+        shared_keys = offset + q_start if causal else key_pos
+        for k_start in range(0, shared_keys, tile_size):
+            scores = score_tile(q_start, q_stop, k_start, min(shared_keys, k_start + tile_size))
+            stats.update_range(scores.amin(-1), scores.amax(-1))
+        if not causal:
+            continue
+        if shared_keys > 0:
+            new_keys = decomposed_k[:, :, key_moments[0] : shared_keys]
+            key_moments = merge_position_moments(key_moments, position_moments(new_keys))
+            merge_scores(position_moments(decomposed_q[:, :, q_start:q_stop]), key_moments)
+        # Then the triangle of keys some of the queries in the tile can see
+        scores = score_tile(q_start, q_stop, shared_keys, offset + q_stop)
+        query_positions = torch.arange(q_stop - q_start, device=scores.device)
+        mask = query_positions[None, :] <= query_positions[:, None]  # [query tile, key tile]
+        stats.update(scores[..., mask.flatten()].movedim(-1, 0))
+    return stats
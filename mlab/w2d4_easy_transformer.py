@@ -1,5 +1,10 @@
 from w2d4_hook_points import HookPoint, HookedRootModule
+from w2d4_attention import efficient_attention, sliding_window_attention, left_pad
+from w2d4_losses import loss_mask
 from transformers import AutoModelForCausalLM, AutoConfig, AutoTokenizer
+import os
+import json
+from contextlib import nullcontext
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -26,12 +31,42 @@ VALID_MODEL_NAMES = [
 #  'EleutherAI/gpt-j-6B',
 #  'EleutherAI/gpt-neox-20b']
 
+# Bump when the conversion changes, so stale weight caches are rebuilt
+WEIGHT_CACHE_VERSION = "1"
+
+
+def meta_device():
+    # A context manager creating tensors on the meta device (ie without
+    # allocating memory) where supported (PyTorch 2.0+), otherwise a no-op
+    if hasattr(torch.device, "__enter__"):
+        return torch.device("meta")
+    return nullcontext()
+
 
 def gelu_new(input):
     # Implementation of GeLU used by GPT2 - subtly different from PyTorch's
     return 0.5 * input * (1.0 + torch.tanh(np.sqrt(2.0 / np.pi) * (input + 0.044715 * torch.pow(input, 3.0))))
 
 
+def quantize_weight_int8(weight):
+    # Symmetric int8 quantization with a scale per row (output feature) of a
+    # [d_out, d_in] weight. Returns the int8 weight and the [d_out] scales
+    scale = weight.abs().amax(-1).clamp(min=1e-12) / 127
+    return torch.round(weight / scale[:, None]).to(torch.int8), scale
+
+
+def int8_linear(x, weight_int8, scale, bias, chunk_rows=4096):
+    # F.linear(x, weight, bias) for a weight quantized by quantize_weight_int8.
+    # The weight is dequantized on the fly to x's dtype, chunk_rows rows at a
+    # time, so there's never a full floating point copy of it in memory
+    out = x.new_empty(x.shape[:-1] + (weight_int8.size(0),))
+    for start in range(0, weight_int8.size(0), chunk_rows):
+        stop = min(weight_int8.size(0), start + chunk_rows)
+        # The scale is per output, so it can be applied after the matmul
+        out[..., start:stop] = F.linear(x, weight_int8[start:stop].to(x.dtype))
+    return torch.addcmul(bias.to(x.dtype), out, scale.to(x.dtype))
+
+
 # Define network architecture
 
 # Embed & Unembed
@@ -40,23 +75,88 @@ class Embed(nn.Module):
         super().__init__()
         self.cfg = cfg
         self.W_E = nn.Parameter(torch.empty(self.cfg["d_model"], self.cfg["d_vocab"]))
+        # If True, W_E is laid out row-major and looked up with F.embedding, see set_row_major
+        self.row_major = False
 
     def forward(self, tokens):
+        if self.row_major:
+            # Gathers a contiguous row per token, already in [batch, pos, d_model] order
+            return F.embedding(tokens, self.W_E.T)
         # If A has shape [a, b] and B has shape [c, d], then A[:, B] has shape [a, c, d]
         # B acts as a tensor of indices into the second dimension (so >=0 and <b)
         return einops.rearrange(self.W_E[:, tokens], "d_model batch pos -> batch pos d_model")
 
+    def set_row_major(self, row_major=True):
+        # Changes how W_E is laid out in memory, not its shape. If row_major, it's
+        # a [d_model, d_vocab] view of a contiguous [d_vocab, d_model] tensor, so
+        # each token's embedding is a contiguous row, otherwise it's contiguous
+        with torch.no_grad():
+            self.W_E.data = self.W_E.T.contiguous().T if row_major else self.W_E.contiguous()
+        self.row_major = row_major
+
 
 class Unembed(nn.Module):
+    # How many vocab entries per_token_losses computes logits for at a time
+    vocab_chunk_size = 4096
+
     def __init__(self, cfg):
         super().__init__()
         self.cfg = cfg
         self.W_U = nn.Parameter(torch.empty(self.cfg["d_vocab"], self.cfg["d_model"]))
         self.b_U = nn.Parameter(torch.empty(self.cfg["d_vocab"]))
+        # If True, W_U is replaced by W_U_int8 and W_U_scale, see quantize_int8
+        self.int8 = False
+        # If True, the logits are computed with a single addmm (bias included)
+        self.row_major = False
 
     def forward(self, tokens):
+        if self.int8:
+            return int8_linear(tokens, self.W_U_int8, self.W_U_scale, self.b_U)  # [batch, pos, d_vocab]
+        if self.row_major:
+            # [batch * pos, d_model] @ [d_model, d_vocab] + b_U, W_U.T is a view
+            logits = torch.addmm(self.b_U, tokens.reshape(-1, tokens.size(-1)), self.W_U.T)
+            return logits.view(tokens.shape[:-1] + (-1,))  # [batch, pos, d_vocab]
         return torch.einsum("vm,bpm->bpv", self.W_U, tokens) + self.b_U  # [batch, pos, d_vocab]
 
+    def chunk_logits(self, x, start, stop):
+        # The logits for vocab entries start to stop, [batch, pos, stop - start]
+        if self.int8:
+            return int8_linear(x, self.W_U_int8[start:stop], self.W_U_scale[start:stop], self.b_U[start:stop])
+        return F.linear(x, self.W_U[start:stop], self.b_U[start:stop])
+
+    def per_token_losses(self, x, targets):
+        # Cross entropy loss of the logits self(x) against targets ([batch, pos]),
+        # ie -log_softmax(self(x))[targets], [batch, pos]. The logits are computed
+        # vocab_chunk_size vocab entries at a time, keeping a running log sum exp
+        # and picking out the target logits as we go, so the full
+        # [batch, pos, d_vocab] logits are never materialized (when gradients
+        # are needed, autograd still keeps every chunk for the backward pass)
+        d_vocab = self.cfg["d_vocab"]
+        log_sum_exp = None
+        target_logits = torch.zeros(targets.shape, device=x.device)  # [batch, pos]
+        for start in range(0, d_vocab, self.vocab_chunk_size):
+            stop = min(d_vocab, start + self.vocab_chunk_size)
+            logits = self.chunk_logits(x, start, stop).float()  # [batch, pos, chunk]
+            chunk_log_sum_exp = logits.logsumexp(-1)  # [batch, pos]
+            if log_sum_exp is None:
+                log_sum_exp = chunk_log_sum_exp
+            else:
+                log_sum_exp = torch.logaddexp(log_sum_exp, chunk_log_sum_exp)
+            in_chunk = (targets >= start) & (targets < stop)
+            index = (targets - start).clamp(0, stop - start - 1)
+            chunk_target_logits = logits.gather(-1, index[..., None])[..., 0]  # [batch, pos]
+            target_logits = torch.where(in_chunk, chunk_target_logits, target_logits)
+        return log_sum_exp - target_logits
+
+    def quantize_int8(self):
+        # Replaces W_U by an int8 copy with a scale per vocab entry, which forward
+        # dequantizes on the fly (weight-only quantization, for inference)
+        W_U_int8, W_U_scale = quantize_weight_int8(self.W_U.detach().float())
+        del self.W_U
+        self.register_buffer("W_U_int8", W_U_int8)
+        self.register_buffer("W_U_scale", W_U_scale)
+        self.int8 = True
+
 
 # Positional Embeddings
 class PosEmbed(nn.Module):
@@ -65,9 +165,15 @@ class PosEmbed(nn.Module):
         self.cfg = cfg
         self.W_pos = nn.Parameter(torch.empty(self.cfg["d_model"], self.cfg["n_ctx"]))
 
-    def forward(self, x):
-        # Output shape [pos, d_model] - will be broadcast along batch dim
-        return self.W_pos[:, : x.size(-1)].T  # [pos, d_model]
+    def forward(self, x, past_length=0, attention_mask=None):
+        # past_length is the number of positions before x (cached in a KeyValueCache)
+        if attention_mask is None:
+            # Output shape [pos, d_model] - will be broadcast along batch dim
+            return self.W_pos[:, past_length : past_length + x.size(-1)].T  # [pos, d_model]
+        # attention_mask is [batch, past_length + pos], with 0 for padding tokens.
+        # With left padding, the first real token of each sequence is position 0
+        positions = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, past_length:]  # [batch, pos]
+        return einops.rearrange(self.W_pos[:, positions], "d_model batch pos -> batch pos d_model")
 
 
 # LayerNormPre
@@ -88,7 +194,7 @@ class LayerNormPre(nn.Module):
     def forward(self, x):
         x = x - x.mean(axis=-1, keepdim=True)  # [batch, pos, d_model]
         scale = self.hook_scale(
-            (einops.reduce(x.pow(2), "batch pos embed -> batch pos 1", "mean") + self.eps).sqrt()
+            (x.pow(2).mean(axis=-1, keepdim=True) + self.eps).sqrt()
         )  # [batch, pos, 1]
         return x / scale
 
@@ -97,6 +203,8 @@ class LayerNormPre(nn.Module):
 class Attention(nn.Module):
     mask: torch.Tensor
     ignore: torch.Tensor
+    # How many heads' results hook_result_chunk gets at a time
+    result_chunk_heads = 1
 
     def __init__(self, cfg, attn_type="global"):
         super().__init__()
@@ -111,22 +219,17 @@ class Attention(nn.Module):
         self.b_O = nn.Parameter(torch.empty(self.cfg["d_model"]))
 
         self.attn_type = attn_type
-        # Create a query_pos x key_pos mask, with True iff that query position
-        # can attend to that key position
-        causal_mask = torch.tril(torch.ones((self.cfg["n_ctx"], self.cfg["n_ctx"])).bool())
-        if self.attn_type == "global":
-            # For global attention, this is a lower triangular matrix - key <= query
-            self.register_buffer("mask", causal_mask)
-        elif self.attn_type == "local":
-            # For local, this is banded, query - window_size < key <= query
-            self.register_buffer("mask", torch.triu(causal_mask, 1 - self.cfg["window_size"]))
-        else:
+        if self.attn_type not in ["global", "local"]:
             raise ValueError(f"Invalid attention type: {self.attn_type}")
-
-        self.register_buffer("IGNORE", torch.tensor(-1e5))
+        self.init_buffers()
+        # W_Q, W_K and W_V packed into one [3, head_index, d_head, d_model] tensor
+        # (and the biases into [3, head_index, d_head]) for use_fused_qkv, see pack_qkv
+        self.register_buffer("W_QKV", None, persistent=False)
+        self.register_buffer("b_QKV", None, persistent=False)
 
         if self.cfg["use_attn_scale"]:
-            self.attn_scale = np.sqrt(self.cfg["d_head"])
+            # A Python float rather than a numpy one, which torch.compile can't trace through
+            self.attn_scale = float(np.sqrt(self.cfg["d_head"]))
         else:
             self.attn_scale = 1.0
 
@@ -136,27 +239,118 @@ class Attention(nn.Module):
         self.hook_z = HookPoint()  # [batch, pos, head_index, d_head]
         self.hook_attn_scores = HookPoint()  # [batch, head_index, query_pos, key_pos]
         self.hook_attn = HookPoint()  # [batch, head_index, query_pos, key_pos]
-        self.hook_result = HookPoint()  # [batch, head_index, head_index, d_model]
-
-    def forward(self, x):
-        q = self.hook_q(torch.einsum("ihm,bpm->bpih", self.W_Q, x) + self.b_Q)  # [batch, pos, head_index, d_head]
-        k = self.hook_k(torch.einsum("ihm,bpm->bpih", self.W_K, x) + self.b_K)  # [batch, pos, head_index, d_head]
-        v = self.hook_v(torch.einsum("ihm,bpm->bpih", self.W_V, x) + self.b_V)  # [batch, pos, head_index, d_head]
-        attn_scores = torch.einsum("bpih,bqih->bipq", q, k) / self.attn_scale  # [batch, head_index, query_pos, key_pos]
-        attn_scores = self.hook_attn_scores(self.causal_mask(attn_scores))  # [batch, head_index, query_pos, key_pos]
-        attn_matrix = self.hook_attn(F.softmax(attn_scores, dim=-1))  # [batch, head_index, query_pos, key_pos]
-        z = self.hook_z(torch.einsum("bpih,biqp->bqih", v, attn_matrix))  # [batch, pos, head_index, d_head]
-        if self.cfg["use_attn_result"]:
-            result = self.hook_result(torch.einsum("imh,bqih->bqim", self.W_O, z))  # [batch, pos, head_index, d_model]
-            out = (
-                einops.reduce(result, "batch position index model->batch position model", "sum") + self.b_O
-            )  # [batch, pos, d_model]
+        self.hook_result = HookPoint()  # [batch, pos, head_index, d_model]
+        # The same, streamed a few heads at a time (hook.head_slice says which),
+        # so hooks only needing eg norms or sums never see the full tensor.
+        # cache_all skips it
+        self.hook_result_chunk = HookPoint(cache_by_default=False)  # [batch, pos, head_chunk, d_model]
+
+    def forward(self, x, past_kv_cache_entry=None, attention_mask=None):
+        # past_kv_cache_entry: If not None, x is only the newest positions, and the
+        # keys and values of the earlier positions are read from (and the new ones
+        # added to) this KeyValueCacheEntry
+        # attention_mask: [batch, key_pos], 0 for padding tokens, which are never attended to
+        if self.cfg["use_fused_qkv"] and not (torch.is_grad_enabled() and self.W_Q.requires_grad):
+            # A single matrix multiply for all three, q, k and v are views of its output
+            if self.W_QKV is None:
+                self.pack_qkv()
+            qkv = F.linear(x, self.W_QKV.flatten(0, 2), self.b_QKV.flatten())  # [batch, pos, 3 * head_index * d_head]
+            q, k, v = qkv.unflatten(-1, self.W_QKV.shape[:3]).unbind(-3)  # [batch, pos, head_index, d_head]
+            q, k, v = self.hook_q(q), self.hook_k(k), self.hook_v(v)
+        else:
+            q = self.hook_q(torch.einsum("ihm,bpm->bpih", self.W_Q, x) + self.b_Q)  # [batch, pos, head_index, d_head]
+            k = self.hook_k(torch.einsum("ihm,bpm->bpih", self.W_K, x) + self.b_K)  # [batch, pos, head_index, d_head]
+            v = self.hook_v(torch.einsum("ihm,bpm->bpih", self.W_V, x) + self.b_V)  # [batch, pos, head_index, d_head]
+        if past_kv_cache_entry is not None:
+            k, v = past_kv_cache_entry.append(k, v)  # [batch, key_pos, head_index, d_head]
+        query_pos, key_pos = q.size(1), k.size(1)
+        if self.hook_attn_scores.has_hooks() or self.hook_attn.has_hooks():
+            attn_scores = torch.einsum("bpih,bqih->bipq", q, k) / self.attn_scale  # [batch, head_index, query_pos, key_pos]
+            attn_scores = self.hook_attn_scores(
+                self.causal_mask(attn_scores, attention_mask)
+            )  # [batch, head_index, query_pos, key_pos]
+            attn_matrix = self.hook_attn(F.softmax(attn_scores, dim=-1))  # [batch, head_index, query_pos, key_pos]
+            z = torch.einsum("bpih,biqp->bqih", v, attn_matrix)  # [batch, pos, head_index, d_head]
+        elif self.attn_type == "local" and key_pos > self.cfg["window_size"]:
+            # Only compute the scores inside the window
+            z = sliding_window_attention(
+                q, k, v, self.cfg["window_size"], self.attn_scale, self.IGNORE, attention_mask
+            )  # [batch, pos, head_index, d_head]
+        else:
+            # Nothing needs the attention pattern, so don't materialize it
+            is_causal = self.attn_type == "global" and attention_mask is None and query_pos == key_pos
+            mask = self.get_mask(query_pos, key_pos, attention_mask)
+            z = efficient_attention(q, k, v, mask, self.attn_scale, self.IGNORE, is_causal)
+        z = self.hook_z(z)  # [batch, pos, head_index, d_head]
+        if self.cfg["use_attn_result"] and (self.hook_result.has_hooks() or self.hook_result_chunk.has_hooks()):
+            out = self.add_head_results(self.b_O, z)  # [batch, pos, d_model]
         else:
             out = torch.einsum("idh,bqih->bqd", self.W_O, z) + self.b_O  # [batch, pos, d_model]
         return out
 
-    def causal_mask(self, attn_scores):
-        return torch.where(self.mask[: attn_scores.size(-2), : attn_scores.size(-1)], attn_scores, self.IGNORE)
+    def add_head_results(self, out, z):
+        # Adds the result of each head to out ([batch, pos, d_model]), running the
+        # use_attn_result hook points. The full [batch, pos, head_index, d_model]
+        # result is only computed if something is hooked on hook_result, otherwise
+        # heads are computed result_chunk_heads at a time for hook_result_chunk
+        n_heads = self.cfg["n_heads"]
+        if self.hook_result.has_hooks():
+            result = self.hook_result(torch.einsum("imh,bqih->bqim", self.W_O, z))  # [batch, pos, head_index, d_model]
+            if not self.hook_result_chunk.has_hooks():
+                return out + einops.reduce(result, "batch position index model->batch position model", "sum")
+        for start in range(0, n_heads, self.result_chunk_heads):
+            heads = slice(start, min(n_heads, start + self.result_chunk_heads))
+            if self.hook_result.has_hooks():
+                result_chunk = result[:, :, heads]
+            else:
+                result_chunk = torch.einsum("imh,bqih->bqim", self.W_O[heads], z[:, :, heads])
+            self.hook_result_chunk.head_slice = heads
+            result_chunk = self.hook_result_chunk(result_chunk)  # [batch, pos, head_chunk, d_model]
+            out = out + result_chunk.sum(-2)
+        return out
+
+    def init_buffers(self, device=None):
+        # Create a query_pos x key_pos mask, with True iff that query position
+        # can attend to that key position
+        causal_mask = torch.tril(torch.ones((self.cfg["n_ctx"], self.cfg["n_ctx"]), device=device).bool())
+        if self.attn_type == "global":
+            # For global attention, this is a lower triangular matrix - key <= query
+            self.register_buffer("mask", causal_mask)
+        else:
+            # For local, this is banded, query - window_size < key <= query
+            self.register_buffer("mask", torch.triu(causal_mask, 1 - self.cfg["window_size"]))
+
+        self.register_buffer("IGNORE", torch.tensor(-1e5, device=device))
+
+    def pack_qkv(self):
+        # Copies W_Q, W_K and W_V into W_QKV, then makes the parameters views of
+        # it, so edits to either are seen by both. The fused path doesn't backprop
+        # into W_QKV, so it's only used when no gradients are needed
+        with torch.no_grad():
+            self.W_QKV = torch.stack([self.W_Q, self.W_K, self.W_V])
+            self.b_QKV = torch.stack([self.b_Q, self.b_K, self.b_V])
+        self.W_Q.data, self.W_K.data, self.W_V.data = self.W_QKV.unbind(0)
+        self.b_Q.data, self.b_K.data, self.b_V.data = self.b_QKV.unbind(0)
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to(), .half() etc convert each parameter separately, which breaks the
+        # views into W_QKV, so repack afterwards
+        super()._apply(fn, *args, **kwargs)
+        if self.W_QKV is not None:
+            self.pack_qkv()
+        return self
+
+    def get_mask(self, query_pos, key_pos, attention_mask=None):
+        # True iff that query position can attend to that key position. The
+        # queries are the last query_pos of the key_pos positions
+        mask = self.mask[key_pos - query_pos : key_pos, :key_pos]  # [query_pos, key_pos]
+        if attention_mask is not None:
+            mask = mask & attention_mask[:, None, None, :key_pos].bool()  # [batch, 1, query_pos, key_pos]
+        return mask
+
+    def causal_mask(self, attn_scores, attention_mask=None):
+        mask = self.get_mask(attn_scores.size(-2), attn_scores.size(-1), attention_mask)
+        return torch.where(mask, attn_scores, self.IGNORE)
 
 
 # MLP Layers
@@ -171,6 +365,8 @@ class MLP(nn.Module):
 
         self.hook_pre = HookPoint()  # [batch, pos, d_mlp]
         self.hook_post = HookPoint()  # [batch, pos, d_mlp]
+        # If True, W_in and W_out are replaced by int8 versions, see quantize_int8
+        self.int8 = False
 
         if self.cfg["act_fn"] == "relu":
             self.act_fn = F.relu
@@ -180,11 +376,25 @@ class MLP(nn.Module):
             raise ValueError(f"Invalid activation function name: {self.cfg['act_fn']}")
 
     def forward(self, x):
+        if self.int8:
+            x = self.hook_pre(int8_linear(x, self.W_in_int8, self.W_in_scale, self.b_in))  # [batch, pos, d_mlp]
+            x = self.hook_post(self.act_fn(x))  # [batch, pos, d_mlp]
+            return int8_linear(x, self.W_out_int8, self.W_out_scale, self.b_out)  # [batch, pos, d_model]
         x = self.hook_pre(torch.einsum("md,bpd->bpm", self.W_in, x) + self.b_in)  # [batch, pos, d_mlp]
         x = self.hook_post(self.act_fn(x))  # [batch, pos, d_mlp]
         x = torch.einsum("dm,bpm->bpd", self.W_out, x) + self.b_out  # [batch, pos, d_model]
         return x
 
+    def quantize_int8(self):
+        # Replaces W_in and W_out by int8 copies with a scale per output feature,
+        # which forward dequantizes on the fly (weight-only quantization, for inference)
+        for name in ["W_in", "W_out"]:
+            weight_int8, scale = quantize_weight_int8(getattr(self, name).detach().float())
+            delattr(self, name)
+            self.register_buffer(f"{name}_int8", weight_int8)
+            self.register_buffer(f"{name}_scale", scale)
+        self.int8 = True
+
 
 # Transformer Block
 class TransformerBlock(nn.Module):
@@ -206,15 +416,62 @@ class TransformerBlock(nn.Module):
         self.hook_resid_mid = HookPoint()  # [batch, pos, d_model]
         self.hook_resid_post = HookPoint()  # [batch, pos, d_model]
 
-    def forward(self, x):
+    def forward(self, x, past_kv_cache_entry=None, attention_mask=None):
         resid_pre = self.hook_resid_pre(x)  # [batch, pos, d_model]
-        attn_out = self.hook_attn_out(self.attn(self.ln1(resid_pre)))  # [batch, pos, d_model]
+        attn_out = self.hook_attn_out(
+            self.attn(self.ln1(resid_pre), past_kv_cache_entry, attention_mask)
+        )  # [batch, pos, d_model]
         resid_mid = self.hook_resid_mid(resid_pre + attn_out)  # [batch, pos, d_model]
         mlp_out = self.hook_mlp_out(self.mlp(self.ln2(resid_mid)))  # [batch, pos, d_model]
         resid_post = self.hook_resid_post(resid_mid + mlp_out)  # [batch, pos, d_model]
         return resid_post
 
 
+# Key value caching for generation
+class KeyValueCacheEntry:
+    """
+    The keys and values of the positions seen so far by one attention layer,
+    stored in buffers preallocated for max_length positions
+    """
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.length = 0
+        self.keys = None
+        self.values = None
+
+    def append(self, k, v):
+        # k, v: [batch, pos, head_index, d_head] for the new positions. Returns
+        # the keys and values of every position so far
+        if self.keys is None:
+            self.keys = k.new_empty((k.size(0), self.max_length, *k.shape[2:]))
+            self.values = v.new_empty((v.size(0), self.max_length, *v.shape[2:]))
+        new_length = self.length + k.size(1)
+        if new_length > self.max_length:
+            raise ValueError(f"Key value cache is full ({self.max_length} positions)")
+        self.keys[:, self.length : new_length] = k
+        self.values[:, self.length : new_length] = v
+        self.length = new_length
+        return self.keys[:, :new_length], self.values[:, :new_length]
+
+
+class KeyValueCache:
+    """
+    A KeyValueCacheEntry per layer. Passing this to EasyTransformer.forward means
+    only the new positions need to be run through the model
+    """
+
+    def __init__(self, n_layers, max_length):
+        self.entries = [KeyValueCacheEntry(max_length) for _ in range(n_layers)]
+
+    def __getitem__(self, layer):
+        return self.entries[layer]
+
+    @property
+    def length(self):
+        return self.entries[0].length
+
+
 # Full transformer
 class EasyTransformer(HookedRootModule):
     """
@@ -225,32 +482,111 @@ class EasyTransformer(HookedRootModule):
     the weights
     """
 
-    def __init__(self, model_name, use_attn_result=False, model=None, keep_original_model=False, center_weights=True):
+    def __init__(
+        self,
+        model_name,
+        use_attn_result=False,
+        model=None,
+        keep_original_model=False,
+        center_weights=True,
+        use_fused_qkv=False,
+        weight_cache_dir=None,
+        dtype=torch.float32,
+        int8_weights=False,
+        row_major_embed=False,
+    ):
         """
         model_name (str): The name of the model to load, via HuggingFace
         use_attn_result (bool): Says whether to explicitly calculate the amount
             each head adds to the residual stream (with a hook) and THEN add it
             up, vs just calculating the sum. This can be very memory intensive
-            for large models, so defaults to False
+            for large models, so defaults to False. Even if True, the per head
+            results are only computed while something is hooked on hook_result
+            (in full) or hook_result_chunk (a few heads at a time)
         model: The loaded model from HuggingFace. If None, it is automatically
             loaded from HuggingFace - this just saves memory if the model was
             already loaded into RAM
         keep_original_model (bool): If False, the original HuggingFace model is
             deleted, otherwise it's kept as a self.model attribute
+        use_fused_qkv (bool): If True, queries, keys and values are computed
+            with a single matrix multiply against a packed copy of W_Q, W_K and
+            W_V whenever gradients aren't needed (see set_fused_qkv)
+        weight_cache_dir (str): If not None, the converted weights (after
+            folding LayerNorm and centering) are saved to a safetensors file in
+            this directory, and later constructions load them from there without
+            loading the HuggingFace model at all. Ignored if model is given (it
+            may have different weights, eg if fine-tuned) or keep_original_model
+        dtype: The dtype of the weights, and so of the activations, eg
+            torch.bfloat16 to halve memory and speed up CPU inference. Weights
+            are converted (and cached) in float32 either way
+        int8_weights (bool): If True, the MLP weights and W_U are stored in int8
+            and dequantized on the fly (see quantize_int8). Activations, and so
+            hooks, stay in dtype
+        row_major_embed (bool): If True, W_E is stored row-major, and the embed
+            and unembed are a single gather and matrix multiply (see
+            set_row_major_embed)
         """
         assert model_name in VALID_MODEL_NAMES
         super().__init__()
         self.model_name = model_name
         self.model_type = self.get_model_type(model_name)
-        if model is not None:
-            self.model = model
-        else:
-            self.model = AutoModelForCausalLM.from_pretrained(model_name)
 
-        self.cfg = self.convert_config(self.model.config, model_type=self.model_type)
+        weight_cache_path = None
+        cached_weights = None
+        if weight_cache_dir is not None and model is None and not keep_original_model:
+            weight_cache_path = os.path.join(weight_cache_dir, self.weight_cache_name(model_name, center_weights))
+            cached_weights = self.load_weight_cache(weight_cache_path)
+
+        if cached_weights is not None:
+            state_dict, self.cfg = cached_weights
+        else:
+            if model is not None:
+                self.model = model
+            else:
+                self.model = AutoModelForCausalLM.from_pretrained(model_name)
+            self.cfg = self.convert_config(self.model.config, model_type=self.model_type)
         self.cfg["use_attn_result"] = use_attn_result
+        self.cfg["use_fused_qkv"] = False
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
 
+        # Every parameter is replaced by a converted weight, so there's no need
+        # to allocate memory for them
+        with meta_device():
+            self.build_modules()
+
+        # Gives each module a parameter with its name (relative to this root module)
+        # Needed for HookPoints to work
+        self.setup_hooks()
+
+        if cached_weights is not None:
+            self.load_converted_state_dict(state_dict)
+        else:
+            # Only free the HuggingFace model's memory as we go if we loaded it
+            release_original = model is None and not keep_original_model
+            self.convert_weights(center_weights, release_original=release_original)
+            if not keep_original_model:
+                # Delete the original model to save memory
+                del self.model
+            if weight_cache_path is not None:
+                self.save_weight_cache(weight_cache_path)
+
+        if int8_weights:
+            self.quantize_int8()
+        self.to(dtype)
+        self.set_fused_qkv(use_fused_qkv)
+        self.set_row_major_embed(row_major_embed)
+        # Set by compile_forward
+        self.compiled_forward = None
+
+    def quantize_int8(self):
+        # Weight-only int8 quantization of the MLP weights and the unembed,
+        # the bulk of the parameters. Quantized weights are no longer available
+        # as parameters (eg blocks[0].mlp.W_in), only as W_in_int8 and W_in_scale
+        for block in self.blocks:
+            block.mlp.quantize_int8()
+        self.unembed.quantize_int8()
+
+    def build_modules(self):
         self.embed = Embed(self.cfg)
         self.hook_embed = HookPoint()  # [batch, pos, d_model]
 
@@ -263,21 +599,30 @@ class EasyTransformer(HookedRootModule):
         self.ln_final = LayerNormPre(self.cfg)
         self.unembed = Unembed(self.cfg)
 
-        # Gives each module a parameter with its name (relative to this root module)
-        # Needed for HookPoints to work
-        self.setup_hooks()
+    def convert_weights(self, center_weights=True, release_original=False):
+        """
+        Loads the weights of self.model (the HuggingFace model), folding in layer
+        norm weights, one layer at a time.
 
-        # Load model weights, and fold in layer norm weights
-        if self.model_type == "gpt2":
-            self.load_gpt2_weights(self.model)
-        elif self.model_type == "neo":
-            self.load_neo_weights(self.model)
-        elif self.model_type == "gptj":
-            self.load_gptj_weights(self.model)
-        elif self.model_type == "neox":
-            self.load_neox_weights(self.model)
-        elif self.model_type == "opt":
-            self.load_opt_weights(self.model)
+        release_original (bool): If True, each HuggingFace layer's weights are
+            freed once converted, so peak memory is about one copy of the model
+            plus one layer. self.model is unusable afterwards. Otherwise
+            converted weights are copies, so self.model is left untouched
+        """
+        get_hf_blocks, convert_embed, convert_block, convert_unembed = self.weight_converters()
+        # Without gradient tracking, the converted weights don't keep the
+        # HuggingFace weights alive through their autograd history
+        with torch.no_grad():
+            for l, hf_block in enumerate(get_hf_blocks(self.model)):
+                self.assign_weights(self.blocks[l], convert_block(hf_block), copy=not release_original)
+                if release_original:
+                    self.release_weights(hf_block)
+            # The unembed can be tied to the embedding, so these are done together
+            weights = {**convert_embed(self.model), **convert_unembed(self.model)}
+            self.assign_weights(self, weights, copy=not release_original)
+            if release_original:
+                self.release_weights(self.model)
+        self.init_buffers()
 
         # Set the average of each weight matrix writing to the residual stream to zero
         # (Layer Norm removes the mean anyway, so this simplifies the weights
@@ -285,27 +630,288 @@ class EasyTransformer(HookedRootModule):
         if center_weights:
             self.center_weights()
 
-        if not keep_original_model:
-            # Delete the original model to save memory
-            del self.model
+    @staticmethod
+    def weight_cache_name(model_name, center_weights):
+        # The cache file for a model and set of processing flags
+        return f"{model_name.replace('/', '--')}.center_weights={center_weights}.safetensors"
+
+    def save_weight_cache(self, path):
+        # Saves the parameters (buffers are rebuilt from the config) with the
+        # config in the file's metadata. Written to a temporary file first, so
+        # a crash never leaves a half written cache behind
+        from safetensors.torch import save_file
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tensors = {name: param.detach().contiguous() for name, param in self.named_parameters()}
+        metadata = {"version": WEIGHT_CACHE_VERSION, "cfg": json.dumps(self.cfg)}
+        save_file(tensors, path + ".tmp", metadata=metadata)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load_weight_cache(path):
+        # Returns (state_dict, cfg) from a weight cache, or None if there's no
+        # up to date cache at path. Tensors are read from a memory map of the file
+        if not os.path.exists(path):
+            return None
+        from safetensors import safe_open
+
+        with safe_open(path, framework="pt") as f:
+            metadata = f.metadata()
+            if metadata.get("version") != WEIGHT_CACHE_VERSION:
+                return None
+            state_dict = {name: f.get_tensor(name) for name in f.keys()}
+        return state_dict, json.loads(metadata["cfg"])
+
+    def load_converted_state_dict(self, state_dict):
+        # Loads already converted parameters, eg from load_weight_cache. The
+        # loaded tensors become the parameters rather than being copied into them
+        missing = {name for name, _ in self.named_parameters()} - set(state_dict)
+        if missing:
+            raise RuntimeError(f"Converted weights don't match the model: missing {sorted(missing)}")
+        self.assign_weights(self, state_dict)
+        self.init_buffers()
+
+    @staticmethod
+    def assign_weights(module, weights, copy=False):
+        # Replaces the parameters of module named in weights (relative to module)
+        # with those tensors. Unlike load_state_dict this doesn't copy (unless
+        # copy=True), so it also works if module was built on the meta device
+        for name, tensor in weights.items():
+            submodule_name, _, param_name = name.rpartition(".")
+            submodule = module.get_submodule(submodule_name)
+            old = getattr(submodule, param_name)
+            if tensor.shape != old.shape:
+                raise RuntimeError(f"Converted {name} has shape {list(tensor.shape)}, expected {list(old.shape)}")
+            tensor = tensor.clone(memory_format=torch.contiguous_format) if copy else tensor.contiguous()
+            setattr(submodule, param_name, nn.Parameter(tensor.to(old.dtype), requires_grad=old.requires_grad))
+
+    @staticmethod
+    def release_weights(module):
+        # Frees the memory of a (converted) HuggingFace module's weights
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            tensor.data = tensor.data.new_empty(0)
+
+    def init_buffers(self):
+        # Buffers aren't loaded with the weights, so if the model was built on
+        # the meta device, create them now
+        for block in self.blocks:
+            if block.attn.mask.is_meta:
+                block.attn.init_buffers(device=block.attn.W_O.device)
+
+    def set_fused_qkv(self, use_fused_qkv=True):
+        # Toggles computing q, k and v with one matrix multiply (inference only,
+        # with gradients enabled the separate weights are always used). hook_q,
+        # hook_k and hook_v see views of the fused output either way
+        self.cfg["use_fused_qkv"] = use_fused_qkv
+        if use_fused_qkv:
+            for block in self.blocks:
+                block.attn.pack_qkv()
+
+    def set_row_major_embed(self, row_major_embed=True):
+        # Toggles storing W_E row-major in memory and looking up tokens with
+        # F.embedding, rather than gathering strided columns and transposing
+        # them, and computing the logits with a single addmm. W_E and W_U keep
+        # their shapes either way, so hooks and anything reading the weights
+        # see no difference
+        self.embed.set_row_major(row_major_embed)
+        self.unembed.row_major = row_major_embed
+
+    def compile_forward(self, **compile_kwargs):
+        """
+        Compiles the forward pass with torch.compile (PyTorch 2.0+), which is then
+        used for every call with no hooks attached, no profiling and no
+        past_kv_cache - eg for scoring a corpus. As soon as a hook is added (or
+        while profiling) calls go back to the eager forward pass, so hooks work
+        exactly as before, and the compiled one is used again once they're removed.
+
+        The config is baked into the compiled graph: torch.compile specializes on
+        the cfg values (and parameter shapes) it sees, so eg set_fused_qkv causes
+        a recompile on the next call rather than a wrong result.
 
-    def forward(self, x):
+        compile_kwargs are passed to torch.compile, eg mode="max-autotune"
+        """
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("compile_forward needs torch.compile, added in PyTorch 2.0")
+        self.compiled_forward = torch.compile(self.run_forward, **compile_kwargs)
+
+    def forward(
+        self,
+        x,
+        start_at_layer=None,
+        stop_at_layer=None,
+        past_kv_cache=None,
+        attention_mask=None,
+        return_type="logits",
+        tokens=None,
+    ):
         # Input x is either a batch of tokens ([batch, pos]) or a text string
-        if type(x) == str:
-            # If text, convert to tokens (batch_size=1)
-            x = self.to_tokens(x)
-        embed = self.hook_embed(self.embed(x))  # [batch, pos, d_model]
-        pos_embed = self.hook_pos_embed(self.pos_embed(x))  # [batch, pos, d_model]
-        residual = embed + pos_embed  # [batch, pos, d_model]
-        for block in self.blocks:
+        # If start_at_layer is given, x is instead the residual stream going into
+        # that layer ([batch, pos, d_model], eg a cached blocks.{layer}.hook_resid_pre)
+        # and the layers before it are skipped
+        # If stop_at_layer is given, the layers from stop_at_layer on are skipped,
+        # and the residual stream going into that layer is returned instead of logits
+        # If past_kv_cache (a KeyValueCache) is given, x only contains the positions
+        # after those already in the cache
+        # attention_mask ([batch, past + pos]) is 0 for left padding tokens
+        # return_type says what to return after the unembed:
+        #   "logits": The logits, [batch, pos, d_vocab]
+        #   "loss": The next token loss at each position, [batch, pos - 1], 0 for
+        #       predictions from or of padding. Computed in vocab chunks (see
+        #       Unembed.per_token_losses), so the logits are never materialized
+        #   "last_logits": Only the logits at the last position, [batch, d_vocab]
+        #       (eg for sampling, which with left padding is the newest token)
+        # tokens: The tokens ([batch, pos]) for return_type="loss" if x isn't tokens
+        if start_at_layer is None:
+            if type(x) == str:
+                # If text, convert to tokens (batch_size=1)
+                x = self.to_tokens(x)
+            elif isinstance(x, list):
+                # A list of strings is left padded, and the padding masked
+                x, attention_mask = self.to_tokens(x, return_attention_mask=True)
+            tokens = x
+        if return_type not in ["logits", "loss", "last_logits"]:
+            raise ValueError(f"Invalid return_type: {return_type}")
+        if return_type == "loss" and tokens is None:
+            raise ValueError('return_type="loss" with start_at_layer needs the tokens passed as tokens')
+        if self.compiled_forward is not None and past_kv_cache is None and not self.hooks_active():
+            return self.compiled_forward(
+                x, start_at_layer, stop_at_layer, attention_mask=attention_mask, return_type=return_type, tokens=tokens
+            )
+        return self.run_forward(x, start_at_layer, stop_at_layer, past_kv_cache, attention_mask, return_type, tokens)
+
+    def run_forward(
+        self,
+        x,
+        start_at_layer=None,
+        stop_at_layer=None,
+        past_kv_cache=None,
+        attention_mask=None,
+        return_type="logits",
+        tokens=None,
+    ):
+        # The eager forward pass, as forward but x must be tokens (or the residual stream)
+        if start_at_layer is None:
+            past_length = 0 if past_kv_cache is None else past_kv_cache.length
+            embed = self.hook_embed(self.embed(x))  # [batch, pos, d_model]
+            pos_embed = self.hook_pos_embed(self.pos_embed(x, past_length, attention_mask))  # [batch, pos, d_model]
+            residual = embed + pos_embed  # [batch, pos, d_model]
+        else:
+            residual = x  # [batch, pos, d_model]
+        for layer in range(self.cfg["n_layers"])[start_at_layer:stop_at_layer]:
             # Note that each block includes skip connections, so we don't need
             # residual + block(residual)
-            residual = block(residual)  # [batch, pos, d_model]
+            past_kv_cache_entry = None if past_kv_cache is None else past_kv_cache[layer]
+            residual = self.blocks[layer](residual, past_kv_cache_entry, attention_mask)  # [batch, pos, d_model]
+        if stop_at_layer is not None:
+            return residual  # [batch, pos, d_model]
+        if return_type == "loss":
+            # Position i predicts token i + 1, so the last position predicts nothing
+            losses = self.unembed.per_token_losses(
+                self.ln_final(residual[:, :-1]), tokens[:, 1:]
+            )  # [batch, pos - 1]
+            if attention_mask is not None:
+                losses = losses * loss_mask(attention_mask[:, -tokens.size(1) :])
+            return losses
+        if return_type == "last_logits":
+            return self.unembed(self.ln_final(residual[:, -1:]))[:, 0]  # [batch, d_vocab]
         x = self.unembed(self.ln_final(residual))  # [batch, pos, d_vocab]
         return x
 
-    def to_tokens(self, text):
-        return self.tokenizer(text, return_tensors="pt")["input_ids"]
+    def to_tokens(self, text, return_attention_mask=False):
+        # text is a string, or a list of strings, which are left padded (see
+        # left_pad). If return_attention_mask, also returns the attention mask
+        # to pass to forward, 0 for padding tokens
+        if type(text) == str:
+            text = [text]
+        tokens, attention_mask = left_pad(self.tokenizer(text)["input_ids"], self.pad_token_id())
+        if return_attention_mask:
+            return tokens, attention_mask
+        return tokens
+
+    def pad_token_id(self):
+        # GPT-2 has no padding token, so pad with end of text. Padding is masked
+        # out, so it doesn't matter which token it is
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        return self.tokenizer.eos_token_id
+
+    @torch.no_grad()
+    def generate(
+        self,
+        input,
+        max_new_tokens,
+        temperature=1.0,
+        top_k=None,
+        attention_mask=None,
+        stop_at_eos=False,
+        use_past_kv_cache=True,
+    ):
+        """
+        Samples max_new_tokens tokens after the input, and returns the input
+        tokens followed by the new ones, [batch, pos + max_new_tokens].
+
+        input: A string, a batch of tokens ([batch, pos]), or a list of strings
+            or of 1D token tensors of different lengths, which are left padded
+        temperature (float): Sampling temperature, 0 means greedy sampling
+        top_k (int): If not None, only sample from the top_k most likely tokens
+        attention_mask: [batch, pos], 0 for (left) padding tokens in input
+        stop_at_eos (bool): If True, stops once every sequence has produced an end
+            of sequence token, and pads sequences that finished early with it
+        use_past_kv_cache (bool): If True, the keys and values of earlier
+            positions are cached, so each step only runs the newest token through
+            the model. Hooks see just that position. If False, each step reruns
+            the whole sequence
+
+        Hooks stay attached during generation, eg use self.hooks(...) around it.
+        """
+        if type(input) == str:
+            tokens = self.to_tokens(input)
+        elif isinstance(input, (list, tuple)) and type(input[0]) == str:
+            tokens, attention_mask = self.to_tokens(list(input), return_attention_mask=True)
+        elif isinstance(input, (list, tuple)):
+            # Left pad, so the newest token of every sequence is at the last position
+            tokens, attention_mask = left_pad(input, self.pad_token_id())
+        else:
+            tokens = input
+        device = self.embed.W_E.device
+        tokens = tokens.to(device)
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(device)
+        batch = tokens.size(0)
+
+        past_kv_cache = KeyValueCache(self.cfg["n_layers"], tokens.size(1) + max_new_tokens) if use_past_kv_cache else None
+        finished = torch.zeros(batch, dtype=torch.bool, device=device)
+        new_tokens = tokens
+        for _ in range(max_new_tokens):
+            if use_past_kv_cache:
+                logits = self(
+                    new_tokens, past_kv_cache=past_kv_cache, attention_mask=attention_mask, return_type="last_logits"
+                )  # [batch, d_vocab]
+            else:
+                logits = self(tokens, attention_mask=attention_mask, return_type="last_logits")  # [batch, d_vocab]
+            next_tokens = self.sample(logits, temperature, top_k)  # [batch]
+            if stop_at_eos:
+                next_tokens[finished] = self.tokenizer.eos_token_id
+                finished |= next_tokens == self.tokenizer.eos_token_id
+            new_tokens = next_tokens[:, None]
+            tokens = torch.cat([tokens, new_tokens], dim=1)
+            if attention_mask is not None:
+                attention_mask = torch.cat([attention_mask, torch.ones_like(new_tokens)], dim=1)
+            if stop_at_eos and finished.all():
+                break
+        return tokens
+
+    @staticmethod
+    def sample(logits, temperature=1.0, top_k=None):
+        # logits: [batch, d_vocab], returns [batch]
+        logits = logits.float()
+        if temperature == 0:
+            return logits.argmax(-1)
+        logits = logits / temperature
+        if top_k is not None:
+            top_logits, top_tokens = logits.topk(top_k, dim=-1)
+            return top_tokens.gather(-1, torch.multinomial(F.softmax(top_logits, dim=-1), 1))[:, 0]
+        return torch.multinomial(F.softmax(logits, dim=-1), 1)[:, 0]
 
     def get_model_type(self, model_name):
         if "gpt2" in model_name:
@@ -390,166 +996,191 @@ class EasyTransformer(HookedRootModule):
             block.attn.W_O.data -= einops.reduce(block.attn.W_O, "index d_model d_head -> index 1 d_head", "mean")
             block.mlp.W_out.data -= block.mlp.W_out.mean(0, keepdim=True)
 
-    def load_gpt2_weights(self, gpt2):
-        sd = self.state_dict()
-
-        sd["embed.W_E"] = gpt2.transformer.wte.weight.T
-        sd["pos_embed.W_pos"] = gpt2.transformer.wpe.weight.T
-
-        for l in range(self.cfg["n_layers"]):
-            # In GPT-2, q,k,v are produced by one big linear map, whose output is
-            # concat([q, k, v])
-            W = gpt2.transformer.h[l].attn.c_attn.weight
-            w_ln_attn = gpt2.transformer.h[l].ln_1.weight
-            W_Q, W_K, W_V = torch.tensor_split(W, 3, dim=1)
-            W_Q = einops.rearrange(W_Q, "m (i h)->i h m", i=self.cfg["n_heads"])
-            W_K = einops.rearrange(W_K, "m (i h)->i h m", i=self.cfg["n_heads"])
-            W_V = einops.rearrange(W_V, "m (i h)->i h m", i=self.cfg["n_heads"])
-
+    def weight_converters(self):
+        # For each model type: (function giving the HuggingFace model's list of
+        # layers, converter for the embeddings, for one layer, and for the unembed).
+        # Each converter returns the converted tensors for that part of the model,
+        # named relative to it (eg "attn.W_Q" for a layer)
+        converters = {
+            "gpt2": (
+                lambda gpt2: gpt2.transformer.h,
+                self.convert_gpt2_embed,
+                self.convert_gpt2_block,
+                self.convert_gpt2_unembed,
+            ),
+            "neo": (
+                lambda neo: neo.transformer.h,
+                self.convert_gpt2_embed,
+                self.convert_neo_block,
+                self.convert_gpt2_unembed,
+            ),
+            "opt": (
+                lambda opt: opt.model.decoder.layers,
+                self.convert_opt_embed,
+                self.convert_opt_block,
+                self.convert_opt_unembed,
+            ),
+        }
+        if self.model_type not in converters:
+            raise NotImplementedError(f"No weight conversion for {self.model_type} models")
+        return converters[self.model_type]
+
+    def convert_gpt2_embed(self, gpt2):
+        # GPT-Neo uses the same names
+        return {
+            "embed.W_E": gpt2.transformer.wte.weight.T,
+            "pos_embed.W_pos": gpt2.transformer.wpe.weight.T,
+        }
+
+    def convert_gpt2_unembed(self, gpt2):
+        W_U = gpt2.lm_head.weight
+        return {
             # Fold in layer norm weights
-            sd[f"blocks.{l}.attn.W_Q"] = W_Q * w_ln_attn
-            sd[f"blocks.{l}.attn.W_K"] = W_K * w_ln_attn
-            sd[f"blocks.{l}.attn.W_V"] = W_V * w_ln_attn
-
-            b_ln = gpt2.transformer.h[l].ln_1.bias
-            qkv_bias = gpt2.transformer.h[l].attn.c_attn.bias
-            qkv_bias = einops.rearrange(
-                qkv_bias, "(qkv index head)->qkv index head", qkv=3, index=self.cfg["n_heads"], head=self.cfg["d_head"]
-            )
+            "unembed.W_U": gpt2.transformer.ln_f.weight[None, :] * W_U,
             # Fold in layer norm biases
-            sd[f"blocks.{l}.attn.b_Q"] = W_Q @ b_ln + qkv_bias[0]
-            sd[f"blocks.{l}.attn.b_K"] = W_K @ b_ln + qkv_bias[1]
-            sd[f"blocks.{l}.attn.b_V"] = W_V @ b_ln + qkv_bias[2]
+            "unembed.b_U": W_U @ gpt2.transformer.ln_f.bias,
+        }
+
+    def convert_gpt2_block(self, block):
+        sd = {}
+        # In GPT-2, q,k,v are produced by one big linear map, whose output is
+        # concat([q, k, v])
+        W = block.attn.c_attn.weight
+        w_ln_attn = block.ln_1.weight
+        W_Q, W_K, W_V = torch.tensor_split(W, 3, dim=1)
+        W_Q = einops.rearrange(W_Q, "m (i h)->i h m", i=self.cfg["n_heads"])
+        W_K = einops.rearrange(W_K, "m (i h)->i h m", i=self.cfg["n_heads"])
+        W_V = einops.rearrange(W_V, "m (i h)->i h m", i=self.cfg["n_heads"])
 
-            W_O = gpt2.transformer.h[l].attn.c_proj.weight
-            W_O = einops.rearrange(W_O, "(i h) m->i m h", i=self.cfg["n_heads"])
-            sd[f"blocks.{l}.attn.W_O"] = W_O
-            sd[f"blocks.{l}.attn.b_O"] = gpt2.transformer.h[l].attn.c_proj.bias
-
-            W_in = gpt2.transformer.h[l].mlp.c_fc.weight.T
-            W_out = gpt2.transformer.h[l].mlp.c_proj.weight.T
-            # Fold in layer norm weights
-            W_in_adj = gpt2.transformer.h[l].ln_2.weight[None, :] * W_in
-            sd[f"blocks.{l}.mlp.W_in"] = W_in_adj
-            # Fold in layer norm biases
-            sd[f"blocks.{l}.mlp.b_in"] = gpt2.transformer.h[l].mlp.c_fc.bias + (W_in @ gpt2.transformer.h[l].ln_2.bias)
-            sd[f"blocks.{l}.mlp.W_out"] = W_out
-            sd[f"blocks.{l}.mlp.b_out"] = gpt2.transformer.h[l].mlp.c_proj.bias
-        W_U = gpt2.lm_head.weight
         # Fold in layer norm weights
-        sd["unembed.W_U"] = gpt2.transformer.ln_f.weight[None, :] * W_U
+        sd["attn.W_Q"] = W_Q * w_ln_attn
+        sd["attn.W_K"] = W_K * w_ln_attn
+        sd["attn.W_V"] = W_V * w_ln_attn
+
+        b_ln = block.ln_1.bias
+        qkv_bias = block.attn.c_attn.bias
+        qkv_bias = einops.rearrange(
+            qkv_bias, "(qkv index head)->qkv index head", qkv=3, index=self.cfg["n_heads"], head=self.cfg["d_head"]
+        )
         # Fold in layer norm biases
-        sd["unembed.b_U"] = gpt2.lm_head.weight @ gpt2.transformer.ln_f.bias
-        self.load_state_dict(sd)
-
-    def load_neo_weights(self, neo):
-        sd = self.state_dict()
-
-        sd["embed.W_E"] = neo.transformer.wte.weight.T
-        sd["pos_embed.W_pos"] = neo.transformer.wpe.weight.T
-
-        for l in range(self.cfg["n_layers"]):
-            w_ln_attn = neo.transformer.h[l].ln_1.weight
-            W_Q = neo.transformer.h[l].attn.attention.q_proj.weight
-            W_K = neo.transformer.h[l].attn.attention.k_proj.weight
-            W_V = neo.transformer.h[l].attn.attention.v_proj.weight
-            W_Q = einops.rearrange(W_Q, "(i h) m->i h m", i=self.cfg["n_heads"])
-            W_K = einops.rearrange(W_K, "(i h) m->i h m", i=self.cfg["n_heads"])
-            W_V = einops.rearrange(W_V, "(i h) m->i h m", i=self.cfg["n_heads"])
-
-            sd[f"blocks.{l}.attn.W_Q"] = W_Q * w_ln_attn
-            sd[f"blocks.{l}.attn.W_K"] = W_K * w_ln_attn
-            sd[f"blocks.{l}.attn.W_V"] = W_V * w_ln_attn
-
-            b_ln = neo.transformer.h[l].ln_1.bias
-            sd[f"blocks.{l}.attn.b_Q"] = W_Q @ b_ln
-            sd[f"blocks.{l}.attn.b_K"] = W_K @ b_ln
-            sd[f"blocks.{l}.attn.b_V"] = W_V @ b_ln
-
-            W_O = neo.transformer.h[l].attn.attention.out_proj.weight
-            W_O = einops.rearrange(W_O, "m (i h)->i m h", i=self.cfg["n_heads"])
-            sd[f"blocks.{l}.attn.W_O"] = W_O
-            sd[f"blocks.{l}.attn.b_O"] = neo.transformer.h[l].attn.attention.out_proj.bias
-
-            W_in = neo.transformer.h[l].mlp.c_fc.weight
-            W_out = neo.transformer.h[l].mlp.c_proj.weight
-            W_in_adj = neo.transformer.h[l].ln_2.weight[None, :] * W_in
-            sd[f"blocks.{l}.mlp.W_in"] = W_in_adj
-            sd[f"blocks.{l}.mlp.b_in"] = neo.transformer.h[l].mlp.c_fc.bias + (W_in @ neo.transformer.h[l].ln_2.bias)
-            sd[f"blocks.{l}.mlp.W_out"] = W_out
-            sd[f"blocks.{l}.mlp.b_out"] = neo.transformer.h[l].mlp.c_proj.bias
-        W_U = neo.lm_head.weight
-        sd["unembed.W_U"] = neo.transformer.ln_f.weight[None, :] * W_U
-        sd["unembed.b_U"] = neo.lm_head.weight @ neo.transformer.ln_f.bias
-        self.load_state_dict(sd)
-
-    def load_neox_weights(self, neox):
-        raise NotImplementedError
+        sd["attn.b_Q"] = W_Q @ b_ln + qkv_bias[0]
+        sd["attn.b_K"] = W_K @ b_ln + qkv_bias[1]
+        sd["attn.b_V"] = W_V @ b_ln + qkv_bias[2]
 
-    def load_gptj_weights(self, gptj):
-        raise NotImplementedError
-
-    def load_opt_weights(self, opt):
-        sd = self.state_dict()
-
-        sd["embed.W_E"] = opt.model.decoder.embed_tokens.weight.T
-        sd["pos_embed.W_pos"] = opt.model.decoder.embed_positions.weight.T[:, 2:]
-
-        for l in range(self.cfg["n_layers"]):
-            w_ln_attn = opt.model.decoder.layers[l].self_attn_layer_norm.weight
-            W_Q = opt.model.decoder.layers[l].self_attn.q_proj.weight
-            W_K = opt.model.decoder.layers[l].self_attn.k_proj.weight
-            W_V = opt.model.decoder.layers[l].self_attn.v_proj.weight
-            W_Q = einops.rearrange(W_Q, "(index d_head) d_model->index d_head d_model", i=self.cfg["n_heads"])
-            W_K = einops.rearrange(W_K, "(index d_head) d_model->index d_head d_model", i=self.cfg["n_heads"])
-            W_V = einops.rearrange(W_V, "(index d_head) d_model->index d_head d_model", i=self.cfg["n_heads"])
-
-            sd[f"blocks.{l}.attn.W_Q"] = W_Q * w_ln_attn
-            sd[f"blocks.{l}.attn.W_K"] = W_K * w_ln_attn
-            sd[f"blocks.{l}.attn.W_V"] = W_V * w_ln_attn
-
-            b_ln = opt.model.decoder.layers[l].self_attn_layer_norm.bias
-            q_bias = einops.rearrange(
-                opt.model.decoder.layers[l].self_attn.q_proj.bias,
-                "(head_index d_head)->head_index d_head",
-                head_index=self.cfg["n_heads"],
-                d_head=self.cfg["d_head"],
-            )
-            k_bias = einops.rearrange(
-                opt.model.decoder.layers[l].self_attn.k_proj.bias,
-                "(head_index d_head)->head_index d_head",
-                head_index=self.cfg["n_heads"],
-                d_head=self.cfg["d_head"],
-            )
-            v_bias = einops.rearrange(
-                opt.model.decoder.layers[l].self_attn.v_proj.bias,
-                "(head_index d_head)->head_index d_head",
-                head_index=self.cfg["n_heads"],
-                d_head=self.cfg["d_head"],
-            )
+        W_O = block.attn.c_proj.weight
+        W_O = einops.rearrange(W_O, "(i h) m->i m h", i=self.cfg["n_heads"])
+        sd["attn.W_O"] = W_O
+        sd["attn.b_O"] = block.attn.c_proj.bias
 
-            sd[f"blocks.{l}.attn.b_Q"] = W_Q @ b_ln + q_bias
-            sd[f"blocks.{l}.attn.b_K"] = W_K @ b_ln + k_bias
-            sd[f"blocks.{l}.attn.b_V"] = W_V @ b_ln + v_bias
-
-            W_O = opt.model.decoder.layers[l].self_attn.out_proj.weight
-            W_O = einops.rearrange(W_O, "d_model (index d_head)->index d_model d_head", i=self.cfg["n_heads"])
-            sd[f"blocks.{l}.attn.W_O"] = W_O
-            sd[f"blocks.{l}.attn.b_O"] = opt.model.decoder.layers[l].self_attn.out_proj.bias
-
-            W_in = opt.model.decoder.layers[l].fc1.weight
-            W_out = opt.model.decoder.layers[l].fc2.weight
-            W_in_adj = opt.model.decoder.layers[l].final_layer_norm.weight[None, :] * W_in
-            sd[f"blocks.{l}.mlp.W_in"] = W_in_adj
-            sd[f"blocks.{l}.mlp.b_in"] = opt.model.decoder.layers[l].fc1.bias + (
-                W_in @ opt.model.decoder.layers[l].final_layer_norm.bias
-            )
-            sd[f"blocks.{l}.mlp.W_out"] = W_out
-            sd[f"blocks.{l}.mlp.b_out"] = opt.model.decoder.layers[l].fc2.bias
+        W_in = block.mlp.c_fc.weight.T
+        W_out = block.mlp.c_proj.weight.T
+        # Fold in layer norm weights
+        W_in_adj = block.ln_2.weight[None, :] * W_in
+        sd["mlp.W_in"] = W_in_adj
+        # Fold in layer norm biases
+        sd["mlp.b_in"] = block.mlp.c_fc.bias + (W_in @ block.ln_2.bias)
+        sd["mlp.W_out"] = W_out
+        sd["mlp.b_out"] = block.mlp.c_proj.bias
+        return sd
+
+    def convert_neo_block(self, block):
+        sd = {}
+        w_ln_attn = block.ln_1.weight
+        W_Q = block.attn.attention.q_proj.weight
+        W_K = block.attn.attention.k_proj.weight
+        W_V = block.attn.attention.v_proj.weight
+        W_Q = einops.rearrange(W_Q, "(i h) m->i h m", i=self.cfg["n_heads"])
+        W_K = einops.rearrange(W_K, "(i h) m->i h m", i=self.cfg["n_heads"])
+        W_V = einops.rearrange(W_V, "(i h) m->i h m", i=self.cfg["n_heads"])
+
+        sd["attn.W_Q"] = W_Q * w_ln_attn
+        sd["attn.W_K"] = W_K * w_ln_attn
+        sd["attn.W_V"] = W_V * w_ln_attn
+
+        b_ln = block.ln_1.bias
+        sd["attn.b_Q"] = W_Q @ b_ln
+        sd["attn.b_K"] = W_K @ b_ln
+        sd["attn.b_V"] = W_V @ b_ln
+
+        W_O = block.attn.attention.out_proj.weight
+        W_O = einops.rearrange(W_O, "m (i h)->i m h", i=self.cfg["n_heads"])
+        sd["attn.W_O"] = W_O
+        sd["attn.b_O"] = block.attn.attention.out_proj.bias
+
+        W_in = block.mlp.c_fc.weight
+        W_out = block.mlp.c_proj.weight
+        W_in_adj = block.ln_2.weight[None, :] * W_in
+        sd["mlp.W_in"] = W_in_adj
+        sd["mlp.b_in"] = block.mlp.c_fc.bias + (W_in @ block.ln_2.bias)
+        sd["mlp.W_out"] = W_out
+        sd["mlp.b_out"] = block.mlp.c_proj.bias
+        return sd
+
+    def convert_opt_embed(self, opt):
+        return {
+            "embed.W_E": opt.model.decoder.embed_tokens.weight.T,
+            # OPT's positional embeddings are offset by 2
+            "pos_embed.W_pos": opt.model.decoder.embed_positions.weight.T[:, 2:],
+        }
+
+    def convert_opt_unembed(self, opt):
         W_U = opt.lm_head.weight
-        sd["unembed.W_U"] = opt.model.decoder.final_layer_norm.weight[None, :] * W_U
-        sd["unembed.b_U"] = W_U @ opt.model.decoder.final_layer_norm.bias
-        self.load_state_dict(sd)
+        return {
+            "unembed.W_U": opt.model.decoder.final_layer_norm.weight[None, :] * W_U,
+            "unembed.b_U": W_U @ opt.model.decoder.final_layer_norm.bias,
+        }
+
+    def convert_opt_block(self, block):
+        sd = {}
+        w_ln_attn = block.self_attn_layer_norm.weight
+        W_Q = block.self_attn.q_proj.weight
+        W_K = block.self_attn.k_proj.weight
+        W_V = block.self_attn.v_proj.weight
+        W_Q = einops.rearrange(W_Q, "(index d_head) d_model->index d_head d_model", index=self.cfg["n_heads"])
+        W_K = einops.rearrange(W_K, "(index d_head) d_model->index d_head d_model", index=self.cfg["n_heads"])
+        W_V = einops.rearrange(W_V, "(index d_head) d_model->index d_head d_model", index=self.cfg["n_heads"])
+
+        sd["attn.W_Q"] = W_Q * w_ln_attn
+        sd["attn.W_K"] = W_K * w_ln_attn
+        sd["attn.W_V"] = W_V * w_ln_attn
+
+        b_ln = block.self_attn_layer_norm.bias
+        q_bias = einops.rearrange(
+            block.self_attn.q_proj.bias,
+            "(head_index d_head)->head_index d_head",
+            head_index=self.cfg["n_heads"],
+            d_head=self.cfg["d_head"],
+        )
+        k_bias = einops.rearrange(
+            block.self_attn.k_proj.bias,
+            "(head_index d_head)->head_index d_head",
+            head_index=self.cfg["n_heads"],
+            d_head=self.cfg["d_head"],
+        )
+        v_bias = einops.rearrange(
+            block.self_attn.v_proj.bias,
+            "(head_index d_head)->head_index d_head",
+            head_index=self.cfg["n_heads"],
+            d_head=self.cfg["d_head"],
+        )
+
+        sd["attn.b_Q"] = W_Q @ b_ln + q_bias
+        sd["attn.b_K"] = W_K @ b_ln + k_bias
+        sd["attn.b_V"] = W_V @ b_ln + v_bias
+
+        W_O = block.self_attn.out_proj.weight
+        W_O = einops.rearrange(W_O, "d_model (index d_head)->index d_model d_head", index=self.cfg["n_heads"])
+        sd["attn.W_O"] = W_O
+        sd["attn.b_O"] = block.self_attn.out_proj.bias
+
+        W_in = block.fc1.weight
+        W_out = block.fc2.weight
+        W_in_adj = block.final_layer_norm.weight[None, :] * W_in
+        sd["mlp.W_in"] = W_in_adj
+        sd["mlp.b_in"] = block.fc1.bias + (W_in @ block.final_layer_norm.bias)
+        sd["mlp.W_out"] = W_out
+        sd["mlp.b_out"] = block.fc2.bias
+        return sd
 
     def load_bloom_weights(self, bloom):
         raise NotImplementedError
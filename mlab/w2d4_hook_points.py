@@ -1,16 +1,54 @@
+import re
+import json
+import time
+import fnmatch
+from collections.abc import Mapping
+from functools import partial
+from contextlib import contextmanager
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import einops
 
+
+def make_name_filter(names):
+    # Turns a description of a set of hook names into a Boolean function on names.
+    # names can be None (every hook), a hook name, a glob pattern (eg
+    # "blocks.*.attn.hook_attn"), a compiled regex (which must match the full
+    # name), a Boolean function on names, or a list of any of these
+    if names is None:
+        return lambda name: True
+    if isinstance(names, re.Pattern):
+        return lambda name: names.fullmatch(name) is not None
+    if callable(names):
+        return names
+    if isinstance(names, str):
+        if any(char in names for char in "*?["):
+            return lambda name: fnmatch.fnmatchcase(name, names)
+        return lambda name: name == names
+    filters = [make_name_filter(n) for n in names]
+    return lambda name: any(f(name) for f in filters)
+
+
 # A helper class to get access to intermediate activations (inspired by Garcon)
 # It's a dummy module that is the identity function by default
 # I can wrap any intermediate activation in a HookPoint and get a convenient
 # way to add PyTorch hooks
 class HookPoint(nn.Module):
-    def __init__(self):
+    # If True, calling a HookPoint skips nn.Module.__call__: a HookPoint with no
+    # hooks just returns its input, and hooks are run directly from the hook
+    # lists. Set to False to go through the standard nn.Module machinery
+    # (eg to compare speed, or if you need global PyTorch module hooks to fire)
+    fast_dispatch = True
+
+    def __init__(self, cache_by_default=True):
         super().__init__()
+        # If False, cache_all (or caching with names=None) skips this hook point,
+        # eg for hook points called several times per forward pass
+        self.cache_by_default = cache_by_default
+        # Hooks are stored as plain functions fn(activation, hook). Backward
+        # hooks get the gradient of the activation instead
         self.fwd_hooks = []
         self.bwd_hooks = []
         self.ctx = {}
@@ -18,41 +56,83 @@ class HookPoint(nn.Module):
         # A variable giving the hook's name (from the perspective of the root
         # module) - this is set by the root module at setup.
         self.name = None
+        # The root module's set of hook points that have had hooks added, so it
+        # can reset just those - also set by the root module at setup.
+        self.hooked_points = None
+        # A HookProfiler while the root module is being profiled
+        self.profiler = None
 
     def add_hook(self, hook, dir="fwd"):
         # Hook format is fn(activation, hook_name)
-        # Change it into PyTorch hook format (this includes input and output,
-        # which are the same for a HookPoint)
-        def full_hook(module, module_input, module_output):
-            return hook(module_output, hook=self)
+        if self.hooked_points is not None:
+            self.hooked_points.add(self)
+        if dir == "fwd":
+            self.fwd_hooks.append(hook)
+        elif dir == "bwd":
+            self.bwd_hooks.append(hook)
+        else:
+            raise ValueError(f"Invalid direction {dir}")
 
+    def remove_hook(self, hook, dir="fwd"):
+        # Removes a single hook function added with add_hook
         if dir == "fwd":
-            handle = self.register_forward_hook(full_hook)
-            self.fwd_hooks.append(handle)
+            self.fwd_hooks.remove(hook)
         elif dir == "bwd":
-            handle = self.register_full_backward_hook(full_hook)
-            self.bwd_hooks.append(handle)
+            self.bwd_hooks.remove(hook)
         else:
             raise ValueError(f"Invalid direction {dir}")
 
     def remove_hooks(self, dir="fwd"):
         if (dir == "fwd") or (dir == "both"):
-            for hook in self.fwd_hooks:
-                hook.remove()
             self.fwd_hooks = []
         if (dir == "bwd") or (dir == "both"):
-            for hook in self.bwd_hooks:
-                hook.remove()
             self.bwd_hooks = []
         if dir not in ["fwd", "bwd", "both"]:
             raise ValueError(f"Invalid direction {dir}")
 
+    def has_hooks(self):
+        # True if any hook functions are attached, ie if calling this hook point
+        # does anything other than return its input. Modules use this to skip
+        # computing activations nothing is looking at
+        return bool(self.fwd_hooks or self.bwd_hooks)
+
+    def __call__(self, x):
+        if self.profiler is not None:
+            return self.profiler.profile_call(self, x)
+        if self.fast_dispatch:
+            if not self.fwd_hooks and not self.bwd_hooks:
+                return x
+            return self.run_hooks(x)
+        return super().__call__(x)
+
+    def run_hooks(self, x):
+        # As with PyTorch forward hooks, a hook returning something other than
+        # None replaces the activation for later hooks and the rest of the model
+        for hook in self.fwd_hooks:
+            out = hook(x, hook=self)
+            if out is not None:
+                x = out
+        if self.bwd_hooks and torch.is_grad_enabled():
+            # Backward hooks are attached to the activation tensor itself, so they
+            # see the gradient of exactly this activation, and still fire if the
+            # hooks are removed between the forward and backward pass.
+            # If nothing upstream needs gradients (eg the parameters are frozen)
+            # we start tracking them here, so we only compute the gradients needed.
+            # This is done on an alias, so the caller's tensor (eg a residual passed
+            # to start_at_layer) is left as it was
+            if not x.requires_grad and x.is_leaf:
+                x = x.detach().requires_grad_()
+            for hook in self.bwd_hooks:
+                # As with forward hooks, returning a tensor replaces the gradient
+                x.register_hook(partial(hook, hook=self))
+        return x
+
     def clear_context(self):
         del self.ctx
         self.ctx = {}
 
     def forward(self, x):
-        return x
+        return self.run_hooks(x)
 
     def layer(self):
         # Returns the layer index if the name has the form 'blocks.{layer}.{...}'
@@ -62,6 +142,185 @@ class HookPoint(nn.Module):
         return int(split_name[1])
 
 
+class HookProfiler:
+    """
+    Records where the time goes in a forward pass, per hook point. For each hook
+    point this records the time spent in the model since the previous hook point
+    (or since the start of the forward pass), the time spent in its hooks, and the
+    bytes its hooks wrote to caches. Create with HookedRootModule.profile.
+
+    synchronize (bool): Whether to synchronize CUDA before every measurement,
+        which is needed for meaningful timings on GPU
+    """
+
+    TAIL = "[after last hook point]"
+
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize
+        self.stats = {}
+        self.last_time = None
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def get_stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = {"name": name, "calls": 0, "model_time": 0.0, "hook_time": 0.0, "cache_bytes": 0}
+        return self.stats[name]
+
+    def start(self):
+        self.last_time = self.now()
+
+    def stop(self):
+        if self.last_time is not None:
+            self.get_stats(self.TAIL)["model_time"] += self.now() - self.last_time
+            self.last_time = None
+
+    def profile_call(self, hp, x):
+        start = self.now()
+        stats = self.get_stats(hp.name)
+        if self.last_time is not None:
+            stats["model_time"] += start - self.last_time
+        if hp.fwd_hooks or hp.bwd_hooks:
+            x = hp.run_hooks(x)
+        self.last_time = self.now()
+        stats["hook_time"] += self.last_time - start
+        stats["calls"] += 1
+        return x
+
+    def record_bytes(self, name, n_bytes):
+        self.get_stats(name)["cache_bytes"] += n_bytes
+
+    def records(self, sort_by="total_time"):
+        # Returns a list of dicts, one per hook point, sorted by sort_by (descending)
+        records = [dict(stats, total_time=stats["model_time"] + stats["hook_time"]) for stats in self.stats.values()]
+        return sorted(records, key=lambda record: record[sort_by], reverse=True)
+
+    def to_json(self, sort_by="total_time"):
+        return json.dumps(self.records(sort_by))
+
+    def table(self, sort_by="total_time", n_rows=None):
+        records = self.records(sort_by)[:n_rows]
+        width = max([len(record["name"]) for record in records] + [4])
+        lines = [f"{'name':<{width}} {'calls':>6} {'model (ms)':>11} {'hooks (ms)':>11} {'total (ms)':>11} {'cache (KB)':>11}"]
+        for r in records:
+            lines.append(
+                f"{r['name']:<{width}} {r['calls']:>6} {r['model_time'] * 1e3:>11.3f} {r['hook_time'] * 1e3:>11.3f} "
+                f"{r['total_time'] * 1e3:>11.3f} {r['cache_bytes'] / 2**10:>11.1f}"
+            )
+        return "\n".join(lines)
+
+
+class ActivationCache(Mapping):
+    """
+    A cache to pass to cache_all/cache_some instead of a dict. It behaves like a
+    dict from hook names to activations, but the activations of per layer hook
+    points (blocks.{layer}.{hook_type}) are stored in a single preallocated
+    [n_layers, ...] tensor per hook type, so we can get all layers at once
+    without copying:
+        cache = ActivationCache(model.cfg["n_layers"])
+        model.cache_some(cache, "blocks.*.attn.hook_attn")
+        model(tokens)
+        attn = cache.stack("attn.hook_attn")  # [layer, batch, head_index, query_pos, key_pos]
+
+    device: If not None, activations are moved to this device when accessed
+        (they're stored on the device they were cached to)
+    """
+
+    def __init__(self, n_layers, device=None):
+        self.n_layers = n_layers
+        self.device = device
+        # hook_type -> [n_layers, ...] tensor, and the layers written to it
+        self.stacked = {}
+        self.layers_cached = {}
+        # Activations that aren't per layer, eg hook_embed
+        self.other = {}
+        # All cached names, in the order they were first cached
+        self.names = {}
+
+    @staticmethod
+    def split_name(name):
+        # "blocks.3.attn.hook_z" -> (3, "attn.hook_z"), None for other names
+        parts = name.split(".", 2)
+        if len(parts) == 3 and parts[0] == "blocks" and parts[1].isdigit():
+            return int(parts[1]), parts[2]
+        return None
+
+    def put(self, name, tensor, device=None, dtype=None):
+        # Stores (a copy of) tensor, converted to device and dtype if not None.
+        # The copies are made outside inference mode even when caching inside it
+        # (eg in head_ablation_sweep), so they can be edited in place afterwards
+        with torch.inference_mode(False):
+            return self._put(name, tensor, device, dtype)
+
+    def _put(self, name, tensor, device, dtype):
+        split = self.split_name(name)
+        if split is None:
+            self.other[name] = tensor.to(device=device, dtype=dtype, copy=True)
+            self.names[name] = None
+            return self.other[name]
+        layer, hook_type = split
+        device = tensor.device if device is None else torch.device(device)
+        dtype = tensor.dtype if dtype is None else dtype
+        storage = self.stacked.get(hook_type)
+        if storage is None or storage.shape[1:] != tensor.shape or storage.dtype != dtype or storage.device != device:
+            # Allocate storage for every layer on first use, or if the shape changes
+            storage = torch.empty((self.n_layers, *tensor.shape), dtype=dtype, device=device)
+            self.stacked[hook_type] = storage
+            self.layers_cached[hook_type] = set()
+        storage[layer].copy_(tensor)
+        self.layers_cached[hook_type].add(layer)
+        self.names[name] = None
+        return storage[layer]
+
+    def __setitem__(self, name, tensor):
+        self.put(name, tensor)
+
+    def to_device(self, tensor):
+        return tensor if self.device is None else tensor.to(self.device)
+
+    def __getitem__(self, name):
+        split = self.split_name(name)
+        if split is None:
+            return self.to_device(self.other[name])
+        layer, hook_type = split
+        if layer not in self.layers_cached.get(hook_type, ()):
+            raise KeyError(name)
+        return self.to_device(self.stacked[hook_type][layer])
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def stack(self, hook_type):
+        """
+        Returns the activations of hook_type (eg "attn.hook_attn") for every layer,
+        with a new leading layer dimension. This is a view of the cache, not a copy
+        (unless it has to be moved to self.device)
+        """
+        missing = set(range(self.n_layers)) - self.layers_cached.get(hook_type, set())
+        if missing:
+            raise KeyError(f"{hook_type} is not cached for layers {sorted(missing)}")
+        return self.to_device(self.stacked[hook_type])
+
+    def stack_heads(self, hook_type):
+        """
+        Like stack, for per head activations, but with the head index moved next
+        to the layer, ie [layer, head_index, ...] (also a view). Eg hook_z
+        becomes [layer, head_index, batch, pos, d_head] and hook_attn becomes
+        [layer, head_index, batch, query_pos, key_pos]
+        """
+        head_dim = 2 if hook_type.endswith("hook_attn") or hook_type.endswith("hook_attn_scores") else 3
+        return self.stack(hook_type).movedim(head_dim, 1)
+
+
 class HookedRootModule(nn.Module):
     # A class building on nn.Module to interface nicely with HookPoints
     # Allows you to name each hook, remove hooks, cache every activation/gradient, etc
@@ -75,15 +334,56 @@ class HookedRootModule(nn.Module):
         # Build a dictionary mapping a module name to the module
         self.mod_dict = {}
         self.hook_dict = {}
+        # Hook points that have had hooks added (or might have a context) since
+        # they were last reset, so resetting is proportional to the number of
+        # hooks used, not to the size of the model
+        self.hooked_points = set()
         for name, module in self.named_modules():
             module.name = name
             self.mod_dict[name] = module
             if type(module) == HookPoint:
                 self.hook_dict[name] = module
+                module.hooked_points = self.hooked_points
+        # Caches of the hook points matching each glob pattern or regex used.
+        # Functions aren't cached, as they may depend on state that changes
+        self.name_filter_matches = {}
+        # The HookProfiler while profiling, see profile
+        self.profiler = None
 
     def hook_points(self):
         return self.hook_dict.values()
 
+    def matching_hook_points(self, names):
+        # Returns the list of hook points whose names match names, which can be
+        # anything make_name_filter accepts. Matches are cached for glob patterns
+        # and regexes, functions are evaluated on every call
+        if isinstance(names, str) and names in self.hook_dict:
+            return [self.hook_dict[names]]
+        if isinstance(names, str) and not any(char in names for char in "*?["):
+            raise ValueError(f"No hook point named {names}")
+        if isinstance(names, (list, tuple)):
+            matches = {}
+            for n in names:
+                matches.update((id(hp), hp) for hp in self.matching_hook_points(n))
+            return list(matches.values())
+        if not isinstance(names, (str, re.Pattern)):
+            name_filter = make_name_filter(names)
+            return [hp for name, hp in self.hook_dict.items() if name_filter(name)]
+        if names not in self.name_filter_matches:
+            name_filter = make_name_filter(names)
+            self.name_filter_matches[names] = [hp for name, hp in self.hook_dict.items() if name_filter(name)]
+        return self.name_filter_matches[names]
+
+    def hooks_active(self):
+        # True if a forward pass would run any hook functions or profiling, ie
+        # if it can't skip the hook points (eg use a compiled forward pass)
+        return self.profiler is not None or any(hp.has_hooks() for hp in self.hooked_points)
+
+    def set_fast_dispatch(self, fast_dispatch=True):
+        # Toggles the HookPoint fast path for every hook point of this model
+        for hp in self.hook_points():
+            hp.fast_dispatch = fast_dispatch
+
     def remove_all_hook_fns(self, direction="both"):
         for hp in self.hook_points():
             hp.remove_hooks(direction)
@@ -92,62 +392,197 @@ class HookedRootModule(nn.Module):
         for hp in self.hook_points():
             hp.clear_context()
 
+    def forget_if_unhooked(self, hp):
+        # Drops hp from hooked_points once it has no hooks or context left
+        if not hp.fwd_hooks and not hp.bwd_hooks and not hp.ctx:
+            self.hooked_points.discard(hp)
+
     def reset_hooks(self, clear_contexts=True, direction="both"):
-        if clear_contexts:
-            self.clear_contexts()
-        self.remove_all_hook_fns(direction)
+        # Only visits the hook points that have been hooked since the last reset
+        for hp in list(self.hooked_points):
+            if clear_contexts:
+                hp.clear_context()
+            hp.remove_hooks(direction)
+            self.forget_if_unhooked(hp)
+
+    @contextmanager
+    def hooks(self, fwd_hooks=[], bwd_hooks=[], reset_hooks_end=True, clear_contexts=False):
+        """
+        Context manager adding hooks for the duration of the block, eg:
+            with model.hooks(fwd_hooks=[("blocks.0.attn.hook_v", ablation_hook)]):
+                logits = model(tokens)
+
+        fwd_hooks, bwd_hooks: As in run_with_hooks
+        reset_hooks_end (bool): If True, the hooks added are removed at the end of
+            the block. Unlike run_with_hooks, hooks that were already there are kept
+        clear_contexts (bool): If True, clears the contexts of the hooked hook
+            points at the end
+        """
+        added = []
+        try:
+            for direction, hooks in [("fwd", fwd_hooks), ("bwd", bwd_hooks)]:
+                for name, hook in hooks:
+                    for hp in self.matching_hook_points(name):
+                        hp.add_hook(hook, dir=direction)
+                        added.append((hp, hook, direction))
+            yield self
+        finally:
+            if reset_hooks_end:
+                for hp, hook, direction in added:
+                    # The hook may already be gone, eg if run_with_hooks reset hooks in the block
+                    if hook in (hp.fwd_hooks if direction == "fwd" else hp.bwd_hooks):
+                        hp.remove_hook(hook, dir=direction)
+                    if clear_contexts:
+                        hp.clear_context()
+                    self.forget_if_unhooked(hp)
+
+    @contextmanager
+    def profile(self, synchronize=False):
+        """
+        Context manager profiling every forward pass in the block per hook point,
+        see HookProfiler. Eg:
+            with model.profile() as profiler:
+                model.run_with_hooks(tokens, fwd_hooks=...)
+            print(profiler.table())
+        When not profiling, the only cost is one attribute check per hook point.
+        """
+        profiler = HookProfiler(synchronize)
+        handles = [
+            self.register_forward_pre_hook(lambda module, inputs: profiler.start()),
+            self.register_forward_hook(lambda module, inputs, output: profiler.stop()),
+        ]
+        self.profiler = profiler
+        for hp in self.hook_points():
+            hp.profiler = profiler
+        try:
+            yield profiler
+        finally:
+            self.profiler = None
+            for hp in self.hook_points():
+                hp.profiler = None
+            for handle in handles:
+                handle.remove()
 
-    def cache_all(self, cache, incl_bwd=False, device="cuda"):
+    def cache_all(self, cache, incl_bwd=False, device=None):
         # Caches all activations wrapped in a HookPoint
+        self.cache_some(cache, None, incl_bwd=incl_bwd, device=device)
+
+    def cache_some(
+        self,
+        cache,
+        names,
+        incl_bwd=False,
+        device=None,
+        dtype=None,
+        pos_slice=None,
+        batch_slice=None,
+        incl_fwd=True,
+    ):
+        """
+        Caches the activations of the hook points selected by names, see
+        make_name_filter for the accepted formats. Only the selected (and sliced)
+        activations are copied, so this can be much cheaper than cache_all.
+        cache can be a dict or an ActivationCache.
+
+        device: The device to store the cache on. If None, activations stay on
+            the device they were computed on
+        dtype: The dtype to store the cache in (eg torch.float16). If None, the
+            activation's dtype is kept
+        pos_slice, batch_slice: An int or slice to keep only some positions or
+            batch elements (dimensions are kept, so -1 gives a length 1 position
+            axis). See slice_activation for which axis counts as the position
+        incl_fwd, incl_bwd (bool): Whether to cache activations, and gradients
+            (stored as cache[name + "_grad"]) respectively
+
+        Eg for attribution patching, cache_some(cache, names, incl_bwd=True)
+        followed by metric(model(tokens)).backward() caches the activations and
+        their gradients in one forward and one backward pass. Gradients are
+        tracked from the first hooked activation, so this works (and is cheaper)
+        with the model's parameters frozen with model.requires_grad_(False).
+        """
+        sliced = pos_slice is not None or batch_slice is not None
+
+        def store(name, tensor, hook):
+            tensor = self.slice_activation(hook.name, tensor.detach(), pos_slice, batch_slice)
+            if isinstance(cache, ActivationCache):
+                # Converted and copied straight into the preallocated storage
+                tensor = cache.put(name, tensor, device=device, dtype=dtype)
+            else:
+                # Copy if we sliced, so the cache doesn't keep the full activation alive
+                tensor = tensor.to(device=device, dtype=dtype, copy=sliced)
+                cache[name] = tensor
+            if hook.profiler is not None:
+                hook.profiler.record_bytes(hook.name, tensor.nelement() * tensor.element_size())
+
         def save_hook(tensor, hook):
-            cache[hook.name] = tensor.detach().to(device)
+            store(hook.name, tensor, hook)
 
         def save_hook_back(tensor, hook):
-            cache[hook.name + "_grad"] = tensor[0].detach().to(device)
+            store(hook.name + "_grad", tensor, hook)
 
-        for hp in self.hook_points():
-            hp.add_hook(save_hook, "fwd")
+        for hp in self.matching_hook_points(names):
+            if names is None and not hp.cache_by_default:
+                continue
+            if incl_fwd:
+                hp.add_hook(save_hook, "fwd")
             if incl_bwd:
                 hp.add_hook(save_hook_back, "bwd")
 
+    def slice_activation(self, name, activation, pos_slice=None, batch_slice=None):
+        # Activations are [batch, pos, ...], apart from attention scores and
+        # patterns which are [batch, head_index, query_pos, key_pos] (these are
+        # sliced along query_pos), and positional embeddings which are [pos, d_model]
+        if pos_slice is None and batch_slice is None:
+            return activation
+        if name.endswith("hook_pos_embed") and activation.dim() == 2:
+            batch_dim, pos_dim = None, 0
+        elif name.endswith("hook_attn") or name.endswith("hook_attn_scores"):
+            batch_dim, pos_dim = 0, 2
+        else:
+            batch_dim, pos_dim = 0, 1
+        index = [slice(None)] * activation.dim()
+        for dim, dim_slice in [(batch_dim, batch_slice), (pos_dim, pos_slice)]:
+            if dim is None or dim_slice is None:
+                continue
+            if isinstance(dim_slice, int):
+                # Keep the dimension
+                dim_slice = slice(dim_slice, (dim_slice + 1) or None)
+            index[dim] = dim_slice
+        return activation[tuple(index)]
+
     def run_with_hooks(
-        self, *args, fwd_hooks=[], bwd_hooks=[], reset_hooks_start=True, reset_hooks_end=True, clear_contexts=False
+        self,
+        *args,
+        fwd_hooks=[],
+        bwd_hooks=[],
+        reset_hooks_start=True,
+        reset_hooks_end=True,
+        clear_contexts=False,
+        **kwargs,
     ):
         """
         fwd_hooks: A list of (name, hook), where name is either the name of
         a hook point or a Boolean function on hook names and hook is the
         function to add to that hook point, or the hook whose names evaluate
-        to True respectively. Ditto bwd_hooks
+        to True respectively. Ditto bwd_hooks. name can also be a glob pattern,
+        a compiled regex or a list, see make_name_filter
         reset_hooks_start (bool): If True, all prior hooks are removed at the start
         reset_hooks_end (bool): If True, all hooks are removed at the end (ie,
         including those added in this run)
         clear_contexts (bool): If True, clears hook contexts whenever hooks are reset
+        Any other arguments are passed on to forward (eg start_at_layer)
 
-        Note that if we want to use backward hooks, we need to set
-        reset_hooks_end to be False, so the backward hooks are still there - this function only runs a forward pass.
+        Backward hooks are attached to the activations during the forward pass,
+        so they fire on a later backward pass through the output even when the
+        hooks are reset at the end.
         """
         if reset_hooks_start:
             self.reset_hooks(clear_contexts)
-        for name, hook in fwd_hooks:
-            if type(name) == str:
-                self.mod_dict[name].add_hook(hook, dir="fwd")
-            else:
-                # Otherwise, name is a Boolean function on names
-                for hook_name, hp in self.hook_dict.items():
-                    if name(hook_name):
-                        hp.add_hook(hook, dir="fwd")
-        for name, hook in bwd_hooks:
-            if type(name) == str:
-                self.mod_dict[name].add_hook(hook, dir="fwd")
-            else:
-                # Otherwise, name is a Boolean function on names
-                for hook_name, hp in self.hook_dict:
-                    if name(hook_name):
-                        hp.add_hook(hook, dir="bwd")
-        out = self.forward(*args)
+        for direction, hooks in [("fwd", fwd_hooks), ("bwd", bwd_hooks)]:
+            for name, hook in hooks:
+                for hp in self.matching_hook_points(name):
+                    hp.add_hook(hook, dir=direction)
+        out = self(*args, **kwargs)
         if reset_hooks_end:
-            if len(bwd_hooks) > 0:
-                print("WARNING: Hooks were reset at the end of run_with_hooks while backward hooks were set.")
-                print("This removes the backward hooks before a backward pass can occur")
             self.reset_hooks(clear_contexts)
         return out
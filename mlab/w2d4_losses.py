@@ -0,0 +1,28 @@
+import torch
+import torch.nn.functional as F
+
+
+def loss_mask(attention_mask):
+    # [batch, pos - 1], True for the predictions that count: a real token
+    # predicted from a real token (so not from or of padding)
+    attention_mask = attention_mask.bool()
+    return attention_mask[:, :-1] & attention_mask[:, 1:]
+
+
+def per_token_losses(logits, tokens, attention_mask=None):
+    # Next token loss at each position, [batch, pos - 1]. If attention_mask is
+    # given, predictions involving padding have loss 0
+    log_probs = F.log_softmax(logits[:, :-1], dim=-1)
+    losses = -torch.gather(log_probs, -1, tokens[:, 1:, None])[..., 0]
+    if attention_mask is not None:
+        losses = losses * loss_mask(attention_mask)
+    return losses
+
+
+def per_sequence_losses(logits, tokens, attention_mask=None):
+    # Mean next token loss of each sequence in the batch, [batch]. If
+    # attention_mask is given, only predictions not involving padding count
+    losses = per_token_losses(logits, tokens, attention_mask)
+    if attention_mask is None:
+        return losses.mean(-1)
+    return losses.sum(-1) / loss_mask(attention_mask).sum(-1).clamp(min=1)
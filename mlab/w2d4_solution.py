@@ -293,6 +293,8 @@ A key thing for doing mechanistic interpretability is being able to access inter
 
 For now, the only thing we'll need is the `cache_all` command to cache all activations - this populates a dictionary mapping each activation's name to its tensor - see the pseudocode above for each activation's name and shape (note that `blocks.0.hook_resid_post == blocks.1.hook_resid_pre` - these are given for convenience)
 
+Caching everything is fine for this tiny model, but gets expensive for big ones. `model.cache_some(cache, names, dtype=..., device=..., pos_slice=...)` only caches the hook points matching `names` (a hook name, a glob like `"blocks.*.attn.hook_attn"`, a regex or a Boolean function on names), optionally cast and sliced.
+
 Running the cell below will print the name and shape of each activation:
 """
 
@@ -711,6 +713,23 @@ if MAIN:
     first_attn_scores = first_attn_detector(cache_2)
     plot_head_scores(first_attn_scores, "First Token Heads")
 
+# %%
+"""
+Looping over layers is fine with 2 layers. For bigger models, an `ActivationCache` stores each hook type for every layer in a single `[n_layers, ...]` tensor, so `stack` gives all layers at once without copying, and we can compute the scores for every layer in one go.
+"""
+from w2d4_hook_points import ActivationCache
+
+if MAIN:
+    attn_cache = ActivationCache(cfg["n_layers"])
+    model.cache_some(attn_cache, "blocks.*.attn.hook_attn")
+    model(tokens_2)
+    model.reset_hooks()
+    stacked_attn = attn_cache.stack("attn.hook_attn")  # [layer, batch, head_index, query_pos, key_pos]
+    stacked_current_attn_scores = reduce(
+        stacked_attn.diagonal(dim1=-2, dim2=-1), "layer batch head_index pos -> layer head_index", "mean"
+    )
+    assert t.allclose(stacked_current_attn_scores.cpu(), current_attn_scores, atol=1e-5)
+
 # %%
 """
 ## Ablations
@@ -802,6 +821,16 @@ if MAIN:
             )
     plot_head_scores(ablation_scores)
 
+# %%
+"""
+This does n_layers * n_heads forward passes, which gets slow for bigger models. `head_ablation_sweep` in `w2d4_ablation.py` does the same thing by repeating the batch once per head, and using a single hook that zeroes a different head in each copy - so all the ablations run in a few big forward passes (split into chunks to fit in `memory_budget` bytes).
+"""
+from w2d4_ablation import head_ablation_sweep
+
+if MAIN:
+    batched_ablation_scores = head_ablation_sweep(model, tokens_2) - original_loss.cpu()
+    assert t.allclose(batched_ablation_scores, ablation_scores, atol=1e-4)
+
 # %%
 
 """
@@ -1132,6 +1161,21 @@ if MAIN:
     except:
         pass
 
+# %%
+"""
+`FactoredCircuit` in `w2d4_circuits.py` avoids building the vocab x vocab matrix at all: it keeps the two thin factors (here W_U W_O, [d_vocab, 128], and W_V W_E, [128, d_vocab]) and computes a block of columns at a time, reducing each to its maximum and the rank of its diagonal entry before moving on. This gives top-k accuracy for any k in one pass.
+"""
+from w2d4_circuits import FactoredCircuit
+
+if MAIN:
+    heads = [4, 10]
+    W_O_heads = t.cat(list(b.attn.W_O[heads]), dim=1)  # [d_model, 2 * d_head]
+    W_V_heads = t.cat(list(b.attn.W_V[heads]), dim=0)  # [2 * d_head, d_model]
+    OV_circuit_factored = FactoredCircuit.from_product(W_U, W_O_heads, W_V_heads, W_E)
+    print("Top 1 accuracy for the full OV Circuit:", OV_circuit_factored.top_k_accuracy(1))
+    print("Top 5 accuracy for the full OV Circuit:", OV_circuit_factored.top_k_accuracy(5))
+    print("Diagonal rank statistics:", OV_circuit_factored.diagonal_rank_stats())
+
 
 # %%
 """
@@ -1309,6 +1353,33 @@ if MAIN:
         title="Attention Scores for component from Q=Embed and K=Prev Token Head",
     )
 
+# %%
+"""
+`decomposed_scores` has n_components^2 * pos^2 entries for a single head, which gets out of hand for bigger models (where every earlier head and MLP is a component) and longer sequences. `decomposed_score_stats` in `w2d4_circuits.py` gets the same statistics for every head of a layer at once, computing the scores for a tile of query and key positions at a time and merging each tile into running statistics (mean, std, min and max over position pairs). For `EasyTransformer` models, `decompose_attn_input` splits the input to a layer's attention into components from a cache.
+"""
+from w2d4_circuits import decompose_qk, decomposed_score_stats
+
+if MAIN:
+    decomposed_q_all, decomposed_k_all = decompose_qk(
+        decomposed_qk_input, model.blocks[1].attn.W_Q, model.blocks[1].attn.W_K
+    )  # [head_index, component, pos, d_head]
+    score_stats = decomposed_score_stats(decomposed_q_all, decomposed_k_all)
+    # decomposed_stds used the unbiased std, the running statistics are over every position pair
+    n_pairs = score_stats.count
+    assert t.allclose(
+        score_stats.std()[ind_head_index] * np.sqrt(n_pairs / (n_pairs - 1)), decomposed_stds, rtol=1e-3, atol=1e-4
+    )
+    px.imshow(
+        to_numpy(score_stats.std()),
+        facet_col=0,
+        facet_col_wrap=4,
+        labels={"x": "Key Component", "y": "Query Component"},
+        x=component_labels,
+        y=component_labels,
+        color_continuous_scale="Blues",
+        title="Standard deviations of components of scores for every head in layer 1",
+    ).show()
+
 # %%
 """
 #### Interpreting the K-Composition Circuit
@@ -1475,6 +1546,18 @@ if MAIN:
     print("Mean:", comp_scores_baseline.mean())
     print("Std:", comp_scores_baseline.std())
     px.histogram(comp_scores_baseline, nbins=50).show()
+
+# %%
+"""
+`composition_baseline` in `w2d4_circuits.py` is the batched version: it draws the random factors for a batch of scores at once, computes the norms from [d_head, d_head] products, and keeps a running mean and std rather than every score, so it's practical to draw far more samples (and for bigger models).
+"""
+from w2d4_circuits import composition_baseline
+
+if MAIN:
+    batched_baseline = composition_baseline(cfg["d_model"], cfg["d_head"], n_samples=10_000)
+    print("Mean:", batched_baseline["mean"])
+    print("Std:", batched_baseline["std"])
+    print("Quantiles:", batched_baseline["quantiles"])
 # %%
 """
 We can re-plot our above graphs with this baseline set to white. Look for interesting things in this graph!
@@ -1557,6 +1640,19 @@ def stranded_composition_score(W_A1: t.Tensor, W_A2: t.Tensor, W_B1: t.Tensor, W
     return SC.pow(2).sum() / normA / normB
 
 
+# %%
+"""
+`composition_scores` in `w2d4_circuits.py` takes this to the whole model: it scores every head against every head in an earlier layer, for each of Q, K and V composition, without ever forming a [d_model, d_model] matrix. It uses a QR decomposition of each thin factor rather than an SVD (we only need norms, so the rotations don't matter), and scores all the heads of a layer against all earlier heads with a single matrix multiply. This takes well under a minute for GPT-2 medium on a CPU.
+"""
+from w2d4_circuits import composition_scores
+
+if MAIN:
+    all_comp_scores = composition_scores(model)
+    assert t.allclose(all_comp_scores["q"][1, :, 0], q_comp_scores, rtol=1e-4)
+    assert t.allclose(all_comp_scores["k"][1, :, 0], k_comp_scores, rtol=1e-4)
+    assert t.allclose(all_comp_scores["v"][1, :, 0], v_comp_scores, rtol=1e-4)
+
+
 # %%
 """
 #### Targeted Ablations